@@ -0,0 +1,76 @@
+"""Серии сообщений подряд и перегруженный провайдер.
+
+1) Каждый из N чатов шлёт K коротких сообщений с паузой между ними. Без склейки
+   (COALESCE_WINDOW=0) каждое сообщение — отдельный ответ и извлечение; со
+   склейкой серия превращается в один ход.
+2) Первые вызовы LLM отвечают 429: клиент должен получить нормальный ответ после
+   паузы со статусом "печатает", а не "Произошла ошибка".
+
+    python bench/bursts.py --chats 20 --burst 4 --gap 0.3
+"""
+import time
+import asyncio
+import argparse
+
+from fakes import FakeBotAPI, FakeLLM, FakeSupabase, default_tables, make_update, reset_bot, settle
+
+import bot
+
+BURST = ["Здравствуйте", "нужен септик", "на дачу", "семья 4 человека", "участок в низине", "когда сможете приехать?"]
+
+
+async def send_burst(chat_id, count, gap):
+    updates = []
+    for text in (BURST * count)[:count]:
+        update = make_update(chat_id, text)
+        updates.append(update)
+        asyncio.ensure_future(bot.handle_message(update, None))
+        await asyncio.sleep(gap)
+    return updates
+
+
+async def bursts(window, args):
+    reset_bot(FakeLLM(latency=args.llm_latency), FakeSupabase(tables=default_tables()), FakeBotAPI(), window=window)
+
+    started = time.perf_counter()
+    sent = await asyncio.gather(*(send_burst(1000 + i, args.burst, args.gap) for i in range(args.chats)))
+    while bot.turns.active:
+        await asyncio.sleep(0.05)
+    elapsed = time.perf_counter() - started
+    await settle()
+
+    messages = args.chats * args.burst
+    replies = sum(len(u.message.replies) for updates in sent for u in updates)
+    print(f"COALESCE_WINDOW={window:<4} сообщений {messages}, ответов {replies}, "
+          f"LLM вызовов {bot.client.calls} ({bot.client.calls / messages:.2f} на сообщение), за {elapsed:.2f} c")
+
+
+async def overload(args):
+    reset_bot(FakeLLM(latency=args.llm_latency, overloaded=args.overloaded), FakeSupabase(tables=default_tables()), FakeBotAPI(), retry_delay=0.2)
+
+    update = make_update(1, "Здравствуйте, нужен септик")
+    started = time.perf_counter()
+    await bot.handle_message(update, None)
+    elapsed = time.perf_counter() - started
+    await settle()
+    reply = update.message.replies[-1]
+    assert reply != "Произошла ошибка, попробуйте позже.", "клиент получил ошибку вместо ответа"
+    print(f"Провайдер отвечал 429 первые {args.overloaded} раз: ответ через {elapsed:.2f} c, "
+          f"\"печатает\" отправлено {update.message.chat.actions} раз, ответ: {reply!r}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--burst", type=int, default=4)
+    parser.add_argument("--gap", type=float, default=0.3)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--overloaded", type=int, default=3)
+    args = parser.parse_args()
+    await bursts(0, args)
+    await bursts(bot.COALESCE_WINDOW, args)
+    await overload(args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
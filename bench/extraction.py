@@ -0,0 +1,44 @@
+"""Вызовы LLM и задержка извлечения данных лида на одно сообщение клиента.
+
+    python bench/extraction.py --messages 20 --llm-latency 0.3
+"""
+import time
+import asyncio
+import argparse
+
+from fakes import FakeBotAPI, FakeLLM, FakeSupabase, default_tables, reset_bot, settle
+
+import bot
+
+DIALOG = [
+    "Здравствуйте, нужен септик",
+    "Для дачи",
+    "Нас человек шесть-семь",
+    "Вода близко, метр примерно",
+    "Михаил, 8 921 950-38-60",
+]
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    args = parser.parse_args()
+
+    reset_bot(FakeLLM(latency=args.llm_latency, extraction_reply='{"name": "Михаил"}'), FakeSupabase(tables=default_tables()), FakeBotAPI())
+    funnel = await bot.get_funnel_questions()
+
+    timings = []
+    for i in range(args.messages):
+        history = [{"role": "user", "content": DIALOG[j % len(DIALOG)]} for j in range(i + 1)]
+        started = time.perf_counter()
+        await bot.extract_and_save_data(7, "bench", funnel, history)
+        timings.append(time.perf_counter() - started)
+    await settle()
+
+    print(f"LLM вызовов на сообщение: {bot.client.calls / args.messages:.2f}")
+    print(f"Извлечение, среднее:      {sum(timings) / len(timings) * 1000:.0f} мс")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
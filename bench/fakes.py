@@ -0,0 +1,295 @@
+"""Локальные заглушки LLM, Supabase и Telegram для нагрузочных прогонов без сети"""
+import os
+import sys
+import time
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+import httpx
+from openai import RateLimitError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeSupabase:
+    """In-memory замена AsyncClient: тот же цепочечный API, счётчик запросов, задержка на каждый запрос"""
+
+    def __init__(self, latency=0.0, tables=None):
+        self.latency = latency
+        self.tables = {name: [dict(r) for r in rows] for name, rows in (tables or {}).items()}
+        self.round_trips = 0
+        self._ids = itertools.count(1)
+        self._clock = itertools.count(1)
+
+    def table(self, name):
+        return _FakeQuery(self, name)
+
+
+class _FakeQuery:
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+        self.op = "select"
+        self.columns = None
+        self.payload = None
+        self.on_conflict = None
+        self.filters = []
+        self.order_by = None
+        self.order_desc = False
+        self.limit_n = None
+        self.count = None
+
+    def select(self, columns="*", count=None):
+        self.columns = None if columns == "*" else [c.strip() for c in columns.split(",")]
+        self.count = count
+        return self
+
+    def insert(self, rows):
+        self.op, self.payload = "insert", rows
+        return self
+
+    def update(self, values):
+        self.op, self.payload = "update", values
+        return self
+
+    def upsert(self, rows, on_conflict=""):
+        self.op, self.payload, self.on_conflict = "upsert", rows, on_conflict
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda r: r.get(column) == value)
+        return self
+
+    def in_(self, column, values):
+        values = list(values)
+        self.filters.append(lambda r: r.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_by, self.order_desc = column, desc
+        return self
+
+    def limit(self, n):
+        self.limit_n = n
+        return self
+
+    def _new_row(self, row):
+        row = dict(row)
+        row.setdefault("id", next(self.db._ids))
+        row.setdefault("created_at", next(self.db._clock))
+        return row
+
+    async def execute(self):
+        self.db.round_trips += 1
+        if self.db.latency:
+            await asyncio.sleep(self.db.latency)
+        rows = self.db.tables.setdefault(self.name, [])
+        matched = [r for r in rows if all(f(r) for f in self.filters)]
+
+        if self.op == "insert":
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            new = [self._new_row(r) for r in payload]
+            rows.extend(new)
+            return SimpleNamespace(data=new)
+        if self.op == "update":
+            for r in matched:
+                r.update(self.payload)
+            return SimpleNamespace(data=[dict(r) for r in matched])
+        if self.op == "upsert":
+            payload = self.payload if isinstance(self.payload, list) else [self.payload]
+            key = self.on_conflict or "id"
+            out = []
+            for item in payload:
+                current = next((r for r in rows if r.get(key) == item.get(key)), None)
+                if current is None:
+                    current = self._new_row(item)
+                    rows.append(current)
+                else:
+                    current.update(item)
+                out.append(dict(current))
+            return SimpleNamespace(data=out)
+
+        total = len(matched)
+        if self.order_by:
+            matched = sorted(matched, key=lambda r: r.get(self.order_by) or 0, reverse=self.order_desc)
+        if self.limit_n is not None:
+            matched = matched[:self.limit_n]
+        if self.columns:
+            matched = [{c: r.get(c) for c in self.columns} for r in matched]
+        else:
+            matched = [dict(r) for r in matched]
+        return SimpleNamespace(data=matched, count=total if self.count else None)
+
+
+def _text(content):
+    """Текст сообщения: строка или список частей (как при cache_control)"""
+    return content if isinstance(content, str) else "".join(p.get("text", "") for p in content)
+
+
+class FakeLLM:
+    """Замена AsyncOpenAI: задержка до первого токена, задержка на каждый токен, подсчёт вызовов.
+
+    Токен здесь — слово ответа: без stream ответ приходит целиком через
+    latency + token_delay * число слов, со stream=True — по словам.
+    Первые overloaded вызовов отвечают 429, как перегруженный провайдер.
+    extraction_reply — строка или функция от текста промпта извлечения.
+    """
+
+    def __init__(self, latency=0.0, reply="Понял вас. Какой у вас тип объекта?", extraction_reply="{}", token_delay=0.0, overloaded=0):
+        self.latency = latency
+        self.overloaded = overloaded
+        self.token_delay = token_delay
+        self.reply = reply
+        self.extraction_reply = extraction_reply
+        self.calls = 0
+        self.system_prompts = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+        self.models = SimpleNamespace(list=self._list_models)
+
+    async def _list_models(self):
+        return SimpleNamespace(data=[SimpleNamespace(id="anthropic/claude-3-haiku")])
+
+    async def _create(self, model, messages, max_tokens=None, stream=False, **kwargs):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.overloaded > 0:
+            self.overloaded -= 1
+            response = httpx.Response(429, request=httpx.Request("POST", "https://llm.bench/v1/chat/completions"))
+            raise RateLimitError("Too many requests", response=response, body=None)
+        texts = [_text(m["content"]) for m in messages]
+        is_extraction = messages[0]["role"] == "user" and "JSON" in texts[0]
+        if not is_extraction:
+            self.system_prompts.append(texts[0])
+        if is_extraction:
+            content = self.extraction_reply(texts[0]) if callable(self.extraction_reply) else self.extraction_reply
+        else:
+            content = self.reply
+        if stream:
+            return self._stream(content)
+        if self.token_delay:
+            await asyncio.sleep(self.token_delay * len(content.split()))
+        prompt_tokens = sum(len(t) for t in texts) // 4
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(content) // 4),
+        )
+
+
+    async def _stream(self, content):
+        for word in content.split(" "):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            delta = SimpleNamespace(content=word + " ")
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+class FakeBotAPI:
+    """Замена общего http-клиента: заявки менеджеру уходят сюда, а не в api.telegram.org"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.posts = []
+
+    async def post(self, url, json=None, **kwargs):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        self.posts.append(json)
+        return SimpleNamespace(json=lambda: {"ok": True, "result": {}})
+
+
+class FakeChat:
+    def __init__(self):
+        self.actions = 0
+
+    async def send_action(self, action):
+        self.actions += 1
+
+
+class FakeMessage:
+    def __init__(self, chat_id, text, username="", first_name="Гость"):
+        self.chat_id = chat_id
+        self.text = text
+        self.from_user = SimpleNamespace(username=username, first_name=first_name)
+        self.chat = FakeChat()
+        self.replies = []
+        self.sent = []
+        self.first_text_at = None
+
+    async def reply_text(self, text, **kwargs):
+        self.replies.append(text)
+        if self.first_text_at is None:
+            self.first_text_at = time.perf_counter()
+        sent = FakeSentMessage(len(self.replies), self.chat_id, text)
+        self.sent.append(sent)
+        return sent
+
+
+class FakeSentMessage:
+    def __init__(self, message_id, chat_id, text):
+        self.message_id = message_id
+        self.chat_id = chat_id
+        self.text = text
+        self.edits = 0
+
+    async def edit_text(self, text, **kwargs):
+        self.edits += 1
+        self.text = text
+        return self
+
+
+_retry_delay = None
+
+
+def reset_bot(llm, db, http_client, window=None, retry_delay=None):
+    """Подключает заглушки и сбрасывает всё состояние бота между прогонами.
+
+    window и retry_delay — склейка ходов и пауза перед повтором LLM на этот прогон;
+    не заданы — значения бота по умолчанию.
+    """
+    global _retry_delay
+    import bot
+    if _retry_delay is None:
+        _retry_delay = bot.LLM_RETRY_DELAY
+    bot.init_clients(llm=llm, db=db, http_client=http_client)
+    bot.config.invalidate()
+    bot.chat_states.invalidate()
+    bot.responses.clear()
+    bot.responses.hits = bot.responses.misses = bot.responses.tokens_saved = 0
+    bot.turns.window = bot.COALESCE_WINDOW if window is None else window
+    bot.LLM_RETRY_DELAY = _retry_delay if retry_delay is None else retry_delay
+
+
+async def settle(timeout=30):
+    """Дожидается фоновых задач и сбрасывает отложенные записи"""
+    import bot
+    await bot.jobs.drain(timeout=timeout)
+    await bot.flush_writes()
+
+
+def make_update(chat_id, text, username=""):
+    """Минимальный Update: handle_message и start_command читают только update.message"""
+    return SimpleNamespace(message=FakeMessage(chat_id, text, username=username))
+
+
+def default_tables():
+    """Типичная конфигурация бота: настройки, три вопроса воронки, пара файлов знаний"""
+    return {
+        "settings": [
+            {"key": "niche", "value": "Септики и автономная канализация"},
+            {"key": "system_prompt", "value": "Ты консультант по септикам."},
+            {"key": "welcome_message", "value": "Добрый день! Чем могу помочь?"},
+            {"key": "collect_name", "value": "true"},
+            {"key": "collect_phone", "value": "true"},
+        ],
+        "funnel_questions": [
+            {"id": 1, "question": "Тип объекта", "agent_task": "Узнай тип объекта", "is_required": True, "order_index": 1},
+            {"id": 2, "question": "Сколько человек", "agent_task": "Узнай число жильцов", "is_required": True, "order_index": 2},
+            {"id": 3, "question": "Уровень грунтовых вод", "agent_task": "Узнай УГВ", "is_required": True, "order_index": 3},
+        ],
+        "knowledge_files": [
+            {"filename": "prices.txt", "content": "Септик на 5 человек — от 90 000 руб. Монтаж — от 35 000 руб."},
+            {"filename": "ugv.txt", "content": "При высоком УГВ нужен септик с принудительным отводом."},
+        ],
+    }
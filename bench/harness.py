@@ -0,0 +1,127 @@
+"""Нагрузочный прогон воронки целиком: 1/10/100/1000 одновременных чатов.
+
+Каждый чат проходит сценарий: /start, ответы на вопросы воронки, имя, телефон и
+вопрос в консультации — следующее сообщение после ответа на предыдущее. LLM,
+Supabase и Bot API — локальные заглушки из fakes.py с настраиваемой задержкой.
+На каждом уровне: пропускная способность, p50/p95/p99 времени обработки
+сообщения, запросы к БД и вызовы LLM на сообщение, сколько лидов дошли до deal_won.
+
+    python bench/harness.py --levels 1,10,100,1000 --llm-latency 0.05 --json .cache/bench.json
+
+Сравнение двух --json прогонов до и после правки показывает регрессию числами.
+"""
+import json
+import time
+import logging
+import asyncio
+import argparse
+
+from fakes import FakeBotAPI, FakeLLM, FakeSupabase, default_tables, make_update, reset_bot, settle
+
+import bot
+
+# Реплика клиента и что из неё извлекла бы модель
+SCRIPT = [
+    ("Здравствуйте, нужен септик на участок", {}),
+    ("Частный дом, живём круглый год", {"funnel": {"Тип объекта": "частный дом"}}),
+    ("Нас четверо, иногда гости — человек шесть", {"funnel": {"Сколько человек": "4-6"}}),
+    ("Участок в низине, весной вода стоит высоко", {"funnel": {"Уровень грунтовых вод": "высокий"}}),
+    ("Меня зовут Иван", {"name": "Иван"}),
+    ("+7 921 123-45-67", {"phone": "+7 921 123-45-67"}),
+    ("А сколько стоит монтаж зимой?", {}),
+]
+
+
+def scripted_extraction(prompt):
+    """Ответ модели на промпт извлечения: поля всех реплик сценария, попавших в диалог"""
+    dialog = prompt.split("Диалог:", 1)[-1]
+    result = {}
+    for text, fields in SCRIPT:
+        if text in dialog:
+            for key, value in fields.items():
+                if isinstance(value, dict):
+                    result.setdefault(key, {}).update(value)
+                else:
+                    result[key] = value
+    return json.dumps(result, ensure_ascii=False)
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))]
+
+
+async def run_chat(chat_id, latencies, think):
+    update = make_update(chat_id, "/start", username=f"user{chat_id}")
+    started = time.perf_counter()
+    await bot.start_command(update, None)
+    latencies.append(time.perf_counter() - started)
+    for text, _ in SCRIPT:
+        if think:
+            await asyncio.sleep(think)
+        update = make_update(chat_id, text, username=f"user{chat_id}")
+        started = time.perf_counter()
+        await bot.handle_message(update, None)
+        latencies.append(time.perf_counter() - started)
+
+
+async def run_level(chats, args):
+    tables = default_tables()
+    tables["settings"] += [{"key": "manager_chat_id", "value": "-100"}, {"key": "bot_token", "value": "0:bench"}]
+    llm = FakeLLM(latency=args.llm_latency, token_delay=args.token_delay, extraction_reply=scripted_extraction)
+    db = FakeSupabase(latency=args.db_latency, tables=tables)
+    bot_api = FakeBotAPI(latency=args.db_latency)
+    reset_bot(llm, db, bot_api, window=args.coalesce_window)
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(*(run_chat(10_000 + i, latencies, args.think) for i in range(chats)))
+    await settle(timeout=600)
+    elapsed = time.perf_counter() - started
+
+    messages = len(latencies)
+    won = sum(1 for lead in db.tables.get("leads", []) if lead.get("stage") == "deal_won")
+    return {
+        "chats": chats,
+        "messages": messages,
+        "seconds": round(elapsed, 3),
+        "throughput": round(messages / elapsed, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "db_per_message": round(db.round_trips / messages, 3),
+        "llm_per_message": round(llm.calls / messages, 3),
+        "deal_won": won,
+        "notifications": len(bot_api.posts),
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--levels", default="1,10,100,1000", help="числа одновременных чатов через запятую")
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--token-delay", type=float, default=0.0)
+    parser.add_argument("--db-latency", type=float, default=0.01)
+    parser.add_argument("--think", type=float, default=0.0, help="пауза клиента перед каждым сообщением, секунды")
+    parser.add_argument("--coalesce-window", type=float, default=None, help="по умолчанию — COALESCE_WINDOW бота")
+    parser.add_argument("--json", help="куда сохранить результаты")
+    parser.add_argument("--verbose", action="store_true", help="логи бота, включая медленные сообщения (на 1000 чатах сами заметно грузят CPU)")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.ERROR)
+
+    print(f"{'чатов':>6} {'сообщ.':>7} {'сек':>7} {'сообщ/с':>8} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} {'БД/сообщ':>9} {'LLM/сообщ':>10} {'deal_won':>9}")
+    results = []
+    for chats in (int(x) for x in args.levels.split(",")):
+        r = await run_level(chats, args)
+        results.append(r)
+        print(f"{r['chats']:>6} {r['messages']:>7} {r['seconds']:>7.2f} {r['throughput']:>8.1f} {r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} "
+              f"{r['p99_ms']:>8.0f} {r['db_per_message']:>9.2f} {r['llm_per_message']:>10.2f} {r['deal_won']:>5}/{r['chats']}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
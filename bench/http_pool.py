@@ -0,0 +1,89 @@
+"""Задержка запроса: новый httpx-клиент на каждый запрос против общего пула с keep-alive.
+
+Поднимает локальный HTTPS-заглушку (самоподписанный сертификат через openssl,
+без openssl — обычный HTTP) и шлёт по N запросов, как send_deal_notification.
+
+    python bench/http_pool.py --requests 200
+"""
+import os
+import ssl
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import fakes  # noqa: F401 — путь к модулям бота
+import httpx
+from aiohttp import web
+
+from http_pool import pooled_client
+
+PORT = 18443
+
+
+def make_tls_context(directory):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    try:
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=127.0.0.1", "-addext", "subjectAltName=IP:127.0.0.1",
+             "-keyout", key, "-out", cert],
+            check=True, capture_output=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    ctx = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    ctx.load_cert_chain(cert, key)
+    return ctx, cert
+
+
+async def send_message(request):
+    return web.json_response({"ok": True, "result": {"message_id": 1}})
+
+
+async def per_request_client(url, n, verify):
+    started = time.perf_counter()
+    for _ in range(n):
+        async with httpx.AsyncClient(verify=verify) as http:
+            await http.post(url, json={"chat_id": 1, "text": "заявка"})
+    return (time.perf_counter() - started) / n
+
+
+async def shared_pool(url, n, verify):
+    http = pooled_client(verify=verify)
+    started = time.perf_counter()
+    for _ in range(n):
+        await http.post(url, json={"chat_id": 1, "text": "заявка"})
+    elapsed = (time.perf_counter() - started) / n
+    await http.aclose()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    tls, cert = make_tls_context(tempfile.mkdtemp())
+    app = web.Application()
+    app.router.add_post("/bot0:bench/sendMessage", send_message)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", PORT, ssl_context=tls).start()
+    scheme = "https" if tls else "http"
+    url = f"{scheme}://127.0.0.1:{PORT}/bot0:bench/sendMessage"
+    verify = ssl.create_default_context(cafile=cert) if cert else True
+
+    await shared_pool(url, 5, verify)  # прогрев
+    fresh = await per_request_client(url, args.requests, verify)
+    pooled = await shared_pool(url, args.requests, verify)
+    await runner.cleanup()
+
+    print(f"схема: {scheme}, запросов: {args.requests}")
+    print(f"новый клиент на запрос: {fresh * 1000:.2f} мс/запрос")
+    print(f"общий пул:              {pooled * 1000:.2f} мс/запрос")
+    print(f"экономия:               {(fresh - pooled) * 1000:.2f} мс/запрос (x{fresh / pooled:.1f})")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,87 @@
+"""Размер промпта и скорость BM25-индекса по мере роста базы знаний.
+
+Сравнивает промпт со всеми файлами целиком и промпт с top-k фрагментами,
+меряет холодную сборку индекса, инкрементальное обновление одного файла,
+загрузку с диска и время запроса.
+
+    python bench/knowledge_retrieval.py --sizes 10 100 1000
+"""
+import os
+import time
+import random
+import argparse
+import tempfile
+
+import fakes  # noqa: F401 — путь к модулям бота
+from knowledge_index import KnowledgeIndex
+from prompts import PromptBuilder, estimate_tokens
+
+TOPICS = [
+    ("цены", "Стоимость септика на {n} человек составляет от {p} 000 рублей, доставка по области бесплатно."),
+    ("монтаж", "Монтаж под ключ занимает {n} дня, бригада копает котлован и подключает станцию к дому."),
+    ("угв", "При высоком уровне грунтовых вод ставим станцию с принудительным отводом и бетонным якорением."),
+    ("зима", "Зимой станция работает без утепления, если глубина промерзания до {n} метров."),
+    ("обслуживание", "Обслуживание раз в {n} месяцев: откачка ила, промывка фильтров, проверка компрессора."),
+    ("грунт", "На глинистом грунте нужен поле фильтрации либо дренажный колодец на {n} кубов."),
+]
+QUERIES = [
+    "сколько стоит септик на 5 человек",
+    "у нас высокие грунтовые воды, что посоветуете",
+    "как долго монтаж",
+    "нужно ли утеплять зимой",
+    "как часто обслуживать станцию",
+]
+
+
+def make_corpus(n_files, seed=1):
+    rnd = random.Random(seed)
+    files = []
+    for i in range(n_files):
+        topic, template = TOPICS[i % len(TOPICS)]
+        paragraphs = [template.format(n=rnd.randint(2, 12), p=rnd.randint(60, 300)) for _ in range(rnd.randint(4, 10))]
+        files.append({"filename": f"{topic}_{i}.txt", "content": "\n\n".join(paragraphs)})
+    return files
+
+
+def run(n_files, top_k):
+    files = make_corpus(n_files)
+    path = os.path.join(tempfile.mkdtemp(), "index.json")
+    settings = {"niche": "Септики", "system_prompt": "Ты консультант по септикам."}
+
+    started = time.perf_counter()
+    index = KnowledgeIndex(path)
+    index.sync(files)
+    build = time.perf_counter() - started
+
+    files[0] = dict(files[0], content=files[0]["content"] + "\n\nНовый абзац про гарантию.")
+    started = time.perf_counter()
+    index.sync(files)
+    incremental = time.perf_counter() - started
+
+    started = time.perf_counter()
+    KnowledgeIndex.load(path)
+    load = time.perf_counter() - started
+
+    started = time.perf_counter()
+    snippets = [index.render(q, top_k) for q in QUERIES]
+    query = (time.perf_counter() - started) / len(QUERIES)
+
+    prompts = PromptBuilder(1, settings, files, [])
+    full_tokens = estimate_tokens(prompts.for_stage(None))
+    rag_tokens = sum(estimate_tokens(prompts.for_stage(None, s)) for s in snippets) // len(snippets)
+    print(f"{n_files:>6} {len(index.chunks):>7} {full_tokens:>11} {rag_tokens:>10} "
+          f"{build * 1000:>9.1f} {incremental * 1000:>8.1f} {load * 1000:>8.1f} {query * 1000:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 5000])
+    parser.add_argument("--top-k", type=int, default=4)
+    args = parser.parse_args()
+    print(f"{'files':>6} {'chunks':>7} {'full_tok':>11} {'topk_tok':>10} {'build_ms':>9} {'incr_ms':>8} {'load_ms':>8} {'query_ms':>8}")
+    for n in args.sizes:
+        run(n, args.top_k)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Нагрузочный прогон: N чатов одновременно против локальных LLM/БД с задержкой.
+
+При полностью асинхронном пути N сообщений завершаются примерно за время одного.
+
+    python bench/load_concurrency.py --chats 50 --llm-latency 0.3 --db-latency 0.02
+"""
+import time
+import asyncio
+import argparse
+
+from fakes import FakeBotAPI, FakeLLM, FakeSupabase, default_tables, make_update, reset_bot, settle
+
+import bot
+
+
+async def run_round(n_chats, llm_latency, db_latency):
+    reset_bot(FakeLLM(latency=llm_latency), FakeSupabase(latency=db_latency, tables=default_tables()), FakeBotAPI())
+    updates = [make_update(chat_id=1000 + i, text="Здравствуйте, нужен септик на дачу") for i in range(n_chats)]
+    started = time.perf_counter()
+    await asyncio.gather(*(bot.handle_message(u, None) for u in updates))
+    elapsed = time.perf_counter() - started
+    await settle()
+    assert all(u.message.replies for u in updates), "не все чаты получили ответ"
+    return elapsed, bot.client.calls, bot.supabase.round_trips
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=50)
+    parser.add_argument("--llm-latency", type=float, default=0.3)
+    parser.add_argument("--db-latency", type=float, default=0.02)
+    args = parser.parse_args()
+
+    one, _, _ = await run_round(1, args.llm_latency, args.db_latency)
+    many, llm_calls, db_calls = await run_round(args.chats, args.llm_latency, args.db_latency)
+    print(f"1 чат:        {one:.3f} c")
+    print(f"{args.chats} чатов:     {many:.3f} c  (x{many / one:.2f} от одного)")
+    print(f"LLM вызовов:  {llm_calls}  запросов к БД: {db_calls}")
+    stats = bot.chat_states.stats()
+    print(f"Состояние чатов: {stats['chats']} чатов, ~{stats['bytes_per_chat']} байт на чат")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
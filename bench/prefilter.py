@@ -0,0 +1,60 @@
+"""Доля реплик, для которых локальный предразбор обходится без LLM, и сохранённая точность.
+
+Размеченный набор — bench/fixtures/prefilter_cases.json: для каждой реплики
+указано, есть ли в ней новые данные лида, и какой телефон/имя в ней названы
+(has_name — у лида уже есть имя). Имя засчитывается, если найдено локально
+или реплика ушла в LLM; ложное имя — чужое слово, принятое за имя без проверки LLM.
+
+    python bench/prefilter.py
+"""
+import os
+import json
+import time
+
+import fakes  # noqa: F401 — путь к модулям бота
+from extraction import prefilter_message
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "prefilter_cases.json")
+
+
+def main():
+    with open(FIXTURES, encoding="utf-8") as f:
+        cases = json.load(f)
+
+    modes = {"skip": 0, "delta": 0, "full": 0}
+    lost, false_names, phone_ok, phone_total, name_ok, name_total = [], [], 0, 0, 0, 0
+    started = time.perf_counter()
+    for case in cases:
+        pre = prefilter_message(case["text"], case["stage"], True, True, case.get("has_name", False))
+        modes[pre["mode"]] += 1
+        contacts = pre["contacts"]
+        if case["phone"]:
+            phone_total += 1
+            phone_ok += contacts.get("phone") == case["phone"]
+        if case["name"]:
+            name_total += 1
+            name_ok += contacts.get("username") == case["name"] or pre["mode"] != "skip"
+        if contacts.get("username") and contacts["username"] != case["name"] and not pre["name_guessed"]:
+            false_names.append(case["text"])
+        # Новые данные потеряны, если LLM пропущен, а локально нашлось не всё
+        if case["new_info"] and pre["mode"] == "skip":
+            found_locally = (case["phone"] or case["name"]) and contacts.get("phone") == case["phone"] and contacts.get("username") == case["name"]
+            if not found_locally:
+                lost.append(case["text"])
+    per_call = (time.perf_counter() - started) / len(cases)
+
+    informative = sum(1 for c in cases if c["new_info"])
+    print(f"реплик: {len(cases)}  с новыми данными: {informative}")
+    print(f"skip: {modes['skip']} ({modes['skip'] / len(cases):.0%})  delta: {modes['delta']}  full: {modes['full']}")
+    print(f"LLM-вызовов извлечения: {modes['delta'] + modes['full']} вместо {len(cases)}")
+    print(f"сохранено реплик с данными: {informative - len(lost)}/{informative}")
+    print(f"телефон распознан: {phone_ok}/{phone_total}  имя: {name_ok}/{name_total}  ложных имён: {len(false_names)}")
+    print(f"время предразбора: {per_call * 1e6:.1f} мкс/реплика")
+    for text in lost:
+        print(f"  потеряно: {text!r}")
+    for text in false_names:
+        print(f"  ложное имя: {text!r}")
+
+
+if __name__ == "__main__":
+    main()
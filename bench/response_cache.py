@@ -0,0 +1,106 @@
+"""Кэш ответов и стабильный префикс промпта в режиме консультации.
+
+Клиенты после deal_won задают вопросы из небольшого набора FAQ — в разном
+регистре и с разной пунктуацией, по очереди. Сравниваются вызовы LLM с кэшем и
+без него, считается доля попаданий, сэкономленные токены и число разных
+системных промптов, ушедших в LLM (для кэширования префикса у провайдера нужен один).
+
+У каждого лида в базе — настоящая переписка воронки: вопросы, имя, телефон и
+благодарность бота с именем клиента. Ключ кэша включает последний обмен репликами,
+поэтому первый вопрос в консультации не попадает никогда; дальше попадания — у
+чатов, где предыдущий вопрос был тем же. Заглушка LLM на один и тот же вопрос
+отвечает одинаково (как модель с temperature=0) — для живой модели это верхняя
+оценка доли попаданий.
+
+    COALESCE_WINDOW=0 python bench/response_cache.py --chats 40 --questions 3
+"""
+import random
+import asyncio
+import argparse
+
+from fakes import FakeBotAPI, FakeLLM, FakeSupabase, default_tables, make_update, reset_bot, settle
+
+import bot
+
+FAQ = [
+    "Сколько стоит септик на 5 человек?",
+    "сколько стоит монтаж септика",
+    "Что делать с грунтовыми водами?",
+    "Какой септик нужен при высоком УГВ?",
+    "Сколько дней занимает монтаж?",
+    "Нужно ли откачивать септик?",
+    "Можно ли ставить септик зимой?",
+    "А гарантия какая?",
+]
+
+
+NAMES = ["Иван", "Ольга", "Сергей", "Марина", "Алексей", "Наталья", "Дмитрий", "Елена"]
+
+
+def funnel_history(chat_id, rnd):
+    """Лид после deal_won и его переписка в воронке, как её сохранил бы бот"""
+    name = rnd.choice(NAMES)
+    phone = f"+7 9{rnd.randrange(10 ** 9):09d}"
+    people = rnd.choice(["двое", "четверо", "человек шесть"])
+    dialog = [
+        ("assistant", "Добрый день! Чем могу помочь?"),
+        ("user", "Здравствуйте, нужен септик"),
+        ("assistant", "Подскажите, для какого объекта?"),
+        ("user", rnd.choice(["Частный дом", "Дача", "Для дачи, живём летом"])),
+        ("assistant", "Сколько человек будет жить?"),
+        ("user", f"Нас {people}"),
+        ("assistant", "Какой уровень грунтовых вод на участке?"),
+        ("user", rnd.choice(["Высокий, весной подтапливает", "Низкий", "Не знаю, вроде метра два"])),
+        ("assistant", "Как к вам обращаться и по какому номеру перезвонить?"),
+        ("user", f"{name}, {phone}"),
+        ("assistant", f"Спасибо, {name}! Менеджер перезвонит вам в течение часа."),
+    ]
+    messages = [{"chat_id": chat_id, "role": role, "content": text, "created_at": f"{chat_id}-{i:02d}"} for i, (role, text) in enumerate(dialog)]
+    lead = {"chat_id": chat_id, "stage": "deal_won", "username": name, "phone": phone, "collected_data": {"Сколько человек": people}}
+    return lead, messages
+
+
+def variant(question, rnd):
+    """Тот же вопрос, как его мог бы набрать другой клиент"""
+    q = question.lower() if rnd.random() < 0.5 else question
+    return q.rstrip("?") + rnd.choice(["?", "??", "", " ?"])
+
+
+async def run(cache_mode, args):
+    rnd = random.Random(args.seed)
+    tables = default_tables()
+    tables["settings"].append({"key": "response_cache", "value": cache_mode})
+    tables["leads"], tables["messages"] = [], []
+    for i in range(args.chats):
+        lead, messages = funnel_history(1000 + i, rnd)
+        tables["leads"].append(lead)
+        tables["messages"] += messages
+    reset_bot(FakeLLM(latency=args.llm_latency), FakeSupabase(tables=tables), FakeBotAPI())
+
+    for turn in range(args.questions):
+        updates = [make_update(1000 + i, variant(rnd.choice(FAQ), rnd)) for i in range(args.chats)]
+        for u in updates:
+            await bot.handle_message(u, None)
+    await settle()
+
+    messages = args.chats * args.questions
+    stats = bot.responses.stats()
+    prefixes = len(set(bot.client.system_prompts))
+    print(f"response_cache={cache_mode:<12} LLM вызовов: {bot.client.calls:>4} на {messages} сообщений, "
+          f"попаданий {stats['hit_rate']:.0%}, сэкономлено ~{stats['tokens_saved']} токенов, "
+          f"разных системных промптов: {prefixes}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--chats", type=int, default=40)
+    parser.add_argument("--questions", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    await run("false", args)
+    await run("consultation", args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,52 @@
+"""Время до первого видимого текста: ответ целиком против потокового ответа с правками.
+
+Консультация после deal_won, длинный ответ (~120 слов), фейковый LLM
+с задержкой до первого токена и на каждый токен.
+
+    python bench/streaming.py --first-token 0.4 --token-delay 0.02
+"""
+import time
+import asyncio
+import argparse
+
+from fakes import FakeBotAPI, FakeLLM, FakeSupabase, default_tables, make_update, reset_bot, settle
+
+import bot
+
+LONG_REPLY = " ".join(
+    ["При высоком уровне грунтовых вод лучше подойдёт станция с принудительным отводом очищенной воды."]
+    + ["Монтаж занимает один-два дня, корпус крепится к бетонной плите, чтобы его не выталкивало весной."] * 8
+)
+
+
+async def measure(mode, args):
+    tables = default_tables()
+    tables["settings"].append({"key": "stream_replies", "value": mode})
+    tables["settings"].append({"key": "stream_edit_interval_ms", "value": str(args.edit_interval_ms)})
+    tables["leads"] = [{"chat_id": 1, "stage": "deal_won", "collected_data": {}}]
+    reset_bot(FakeLLM(latency=args.first_token, token_delay=args.token_delay, reply=LONG_REPLY), FakeSupabase(tables=tables), FakeBotAPI())
+
+    update = make_update(1, "А что делать с грунтовыми водами?")
+    started = time.perf_counter()
+    await bot.handle_message(update, None)
+    total = time.perf_counter() - started
+    await settle()
+    first = update.message.first_text_at - started
+    edits = sum(m.edits for m in update.message.sent)
+    final = update.message.sent[-1].text
+    assert final == LONG_REPLY.strip(), "финальный текст не совпал с ответом модели"
+    print(f"{mode:>6}: первый текст {first:.2f} c, весь ответ {total:.2f} c, правок {edits}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--first-token", type=float, default=0.4)
+    parser.add_argument("--token-delay", type=float, default=0.02)
+    parser.add_argument("--edit-interval-ms", type=int, default=1000)
+    args = parser.parse_args()
+    await measure("false", args)
+    await measure("true", args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
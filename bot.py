@@ -1,11 +1,27 @@
 import os
 import re
-import json
+import time
+import signal
+import itertools
+import asyncio
 import logging
-from openai import OpenAI
-from supabase import create_client
+from aiohttp import web
+from datetime import datetime, timezone
+from contextlib import asynccontextmanager
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
 from telegram import Update
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ApplicationBuilder, MessageHandler, CommandHandler, filters, ContextTypes
+from prompts import PromptBuilder, trim_history, with_context, estimate_tokens
+from http_pool import PooledSupabase, pooled_client
+from knowledge_index import KnowledgeIndex
+from jobs import ChatJobQueue
+from chat_state import ChatState, ChatStateCache
+from write_behind import WriteBehindBuffer
+from extraction import build_extraction_prompt, extraction_schema, parse_extraction, prefilter_message
+from response_cache import ResponseCache, mentions
+from turns import ChatTurns
+from metrics import REGISTRY, timed, start_trace, stop_trace, log_if_slow
 
 logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
@@ -17,409 +33,938 @@ BOT_TOKEN = os.environ.get("BOT_TOKEN")
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
 SUPABASE_URL = os.environ.get("SUPABASE_URL")
 SUPABASE_KEY = os.environ.get("SUPABASE_KEY")
+# Сколько апдейтов PTB обрабатывает одновременно (разные чаты не ждут друг друга)
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "64"))
+# HTTP-сервер (health и webhook). WEBHOOK_URL задан — режим webhook, иначе polling
+PORT = int(os.environ.get("PORT", 8000))
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL", "")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+WEBHOOK_PATH = "/telegram"
+HEALTH_CACHE_SECONDS = 15
+HEALTH_TIMEOUT = 3
+# Как долго снимок настроек считается свежим, секунды
+CONFIG_TTL = int(os.environ.get("CONFIG_TTL", "300"))
+# Не реже чем раз в столько секунд снимок перечитывается целиком, даже если отпечаток не изменился
+CONFIG_MAX_AGE = int(os.environ.get("CONFIG_MAX_AGE", "1800"))
+# Кто может вызывать /reload (помимо manager_chat_id из settings), через запятую
+ADMIN_CHAT_IDS = {x.strip() for x in os.environ.get("ADMIN_CHAT_IDS", "").split(",") if x.strip()}
+# Где лежит BM25-индекс файлов знаний и сколько фрагментов класть в промпт
+KNOWLEDGE_INDEX_PATH = os.environ.get("KNOWLEDGE_INDEX_PATH", ".cache/knowledge_index.json")
+KNOWLEDGE_TOP_K = 4
+# Фоновые задачи (извлечение данных, заявки менеджеру): сколько одновременно и сколько повторов
+JOB_CONCURRENCY = int(os.environ.get("JOB_CONCURRENCY", "8"))
+JOB_RETRIES = int(os.environ.get("JOB_RETRIES", "2"))
+# Состояние активных чатов в памяти: сколько чатов, сколько секунд простоя, сколько сообщений истории
+CHAT_STATE_MAX_CHATS = int(os.environ.get("CHAT_STATE_MAX_CHATS", "2000"))
+CHAT_STATE_IDLE_TTL = int(os.environ.get("CHAT_STATE_IDLE_TTL", "1800"))
+HISTORY_LIMIT = int(os.environ.get("HISTORY_LIMIT", "20"))
+# Предел памяти под историю: на один чат и на все чаты вместе, байты
+CHAT_STATE_MAX_BYTES_PER_CHAT = int(os.environ.get("CHAT_STATE_MAX_BYTES_PER_CHAT", str(64 * 1024)))
+CHAT_STATE_MAX_BYTES = int(os.environ.get("CHAT_STATE_MAX_BYTES", str(64 * 1024 * 1024)))
+# Отложенная запись: размер пачки и максимальная задержка сброса, секунды
+WRITE_BATCH_SIZE = int(os.environ.get("WRITE_BATCH_SIZE", "50"))
+WRITE_FLUSH_INTERVAL = float(os.environ.get("WRITE_FLUSH_INTERVAL", "1.0"))
+# Сколько сбросов подряд может не пройти, прежде чем /health ответит 503
+WRITE_FAILURES_NOT_READY = 3
+LEAD_COLUMNS = ("chat_id", "stage", "phone", "username", "tg_username", "collected_data")
+# Потоковые ответы: пауза между правками сообщения и предел ожидания первого предложения
+STREAM_EDIT_INTERVAL_MS = 1000
+STREAM_FIRST_CHUNK_MAX = 200
+SENTENCE_END_RE = re.compile(r"[.!?…](?=\s)")
+# Кэш готовых ответов: сколько записей и сколько секунд живёт запись
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "500"))
+RESPONSE_CACHE_TTL = int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+# Серия сообщений подряд — один ход: пауза тишины, максимум ожидания (секунды) и сообщений в ходе
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "0.8"))
+COALESCE_MAX_WAIT = float(os.environ.get("COALESCE_MAX_WAIT", "3.0"))
+COALESCE_MAX_MESSAGES = int(os.environ.get("COALESCE_MAX_MESSAGES", "10"))
+# Сколько запросов к LLM одновременно на весь процесс и сколько секунд ждать перегруженного провайдера
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "16"))
+LLM_QUEUE_TIMEOUT = float(os.environ.get("LLM_QUEUE_TIMEOUT", "60"))
+LLM_RETRY_DELAY = 1.0
+# Telegram гасит "печатает" через 5 секунд — повторяем чаще
+TYPING_INTERVAL = 4.0
+# Сообщения дольше этого порога пишутся в лог с разбивкой по этапам, секунды (0 — выключено)
+SLOW_REQUEST_SECONDS = float(os.environ.get("SLOW_REQUEST_SECONDS", "5"))
+
+# Асинхронные клиенты: пока один чат ждёт LLM или базу, event loop обслуживает остальные.
+# Создаются в init_clients() при запуске, а не при импорте — тесты и бенчмарки подставляют свои
+http = None
+client = None
+supabase = None
+knowledge = KnowledgeIndex.load(KNOWLEDGE_INDEX_PATH)
+jobs = ChatJobQueue(max_concurrency=JOB_CONCURRENCY, retries=JOB_RETRIES)
+responses = ResponseCache(max_items=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+llm_slots = asyncio.Semaphore(LLM_CONCURRENCY)
+# Ошибки, при которых провайдер скорее перегружен, чем запрос плохой — имеет смысл подождать и повторить
+LLM_OVERLOAD_ERRORS = (RateLimitError, InternalServerError, APITimeoutError, APIConnectionError)
+
+# Метрики для /metrics: время по этапам и расход токенов
+DB_SECONDS = REGISTRY.histogram("bot_db_query_seconds", "Supabase query latency", ["query"])
+LLM_SECONDS = REGISTRY.histogram("bot_llm_request_seconds", "LLM request latency (streaming: until the last chunk)", ["purpose"])
+LLM_TOKENS = REGISTRY.counter("bot_llm_tokens_total", "LLM tokens reported by the API", ["purpose", "kind"])
+LLM_ERRORS = REGISTRY.counter("bot_llm_errors_total", "Failed LLM requests", ["purpose"])
+LLM_WAIT_SECONDS = REGISTRY.histogram("bot_wait_llm_slot_seconds", "Time spent waiting for a free LLM_CONCURRENCY slot", ["purpose"])
+TG_SECONDS = REGISTRY.histogram("bot_telegram_send_seconds", "Telegram Bot API call latency", ["method"])
+FIRST_TEXT_SECONDS = REGISTRY.histogram("bot_first_text_seconds", "Time from incoming message (first of the turn) to the first text sent", ["mode"])
+RESPONSE_CACHE_LOOKUPS = REGISTRY.counter("bot_response_cache_total", "Response cache lookups", ["result"])
+RESPONSE_CACHE_TOKENS = REGISTRY.counter("bot_response_cache_tokens_saved_total", "Estimated LLM tokens saved by response cache hits")
+MESSAGE_SECONDS = REGISTRY.histogram("bot_handle_message_seconds", "End-to-end latency, from the incoming message (first of the turn) to the saved reply")
+COALESCED_MESSAGES = REGISTRY.counter("bot_coalesced_messages_total", "Messages merged into an earlier message's turn")
+DROPPED_MESSAGES = REGISTRY.counter("bot_dropped_messages_total", "Messages left out of the reply because too many were waiting in one chat (still saved)")
+
+
+async def db_execute(name, query):
+    """Выполняет запрос PostgREST и пишет его время в bot_db_query_seconds{query=name}"""
+    with timed(DB_SECONDS, query=name):
+        return await query.execute()
+
+
+@asynccontextmanager
+async def llm_slot(purpose):
+    """Место в общем лимите одновременных запросов к LLM (LLM_CONCURRENCY)"""
+    with timed(LLM_WAIT_SECONDS, purpose=purpose):
+        await llm_slots.acquire()
+    try:
+        yield
+    finally:
+        llm_slots.release()
+
+
+async def retry_overloaded(purpose, call):
+    """call() повторяется с паузой, пока провайдер перегружен (429, 5xx, таймаут), но не дольше LLM_QUEUE_TIMEOUT"""
+    deadline = time.monotonic() + LLM_QUEUE_TIMEOUT
+    for attempt in itertools.count():
+        try:
+            return await call()
+        except LLM_OVERLOAD_ERRORS as e:
+            delay = min(LLM_RETRY_DELAY * 2 ** attempt, 10)
+            if time.monotonic() + delay > deadline:
+                raise
+            LLM_ERRORS.inc(purpose=purpose)
+            logger.warning(f"LLM overloaded ({type(e).__name__}), {purpose} retry {attempt + 1} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+
+@asynccontextmanager
+async def typing_keepalive(chat):
+    """Статус "печатает" всё время, пока ход ждёт очереди к LLM и генерации"""
+    async def keep():
+        while True:
+            try:
+                with timed(TG_SECONDS, method="typing"):
+                    await chat.send_action("typing")
+            except Exception as e:
+                logger.warning(f"Typing action failed: {e}")
+            await asyncio.sleep(TYPING_INTERVAL)
 
-client = OpenAI(
-    api_key=OPENROUTER_API_KEY,
-    base_url="https://api.polza.ai/v1"
-)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-
-def get_funnel_questions():
+    task = asyncio.create_task(keep())
     try:
-        result = supabase.table("funnel_questions").select("id,question,agent_task,is_required").eq("is_required", True).order("order_index").execute()
-        return result.data if result.data else []
-    except Exception as e:
-        logger.error(f"Error getting funnel questions: {e}")
-        return []
+        yield
+    finally:
+        task.cancel()
+
+
+def record_usage(purpose, response):
+    usage = getattr(response, "usage", None)
+    if usage:
+        LLM_TOKENS.inc(usage.prompt_tokens or 0, purpose=purpose, kind="prompt")
+        LLM_TOKENS.inc(usage.completion_tokens or 0, purpose=purpose, kind="completion")
+
+
+def init_clients(llm=None, db=None, http_client=None):
+    """Клиенты LLM, базы и HTTP для заявок; не переданные создаются из окружения.
+
+    http — общий пул (HTTP/2, keep-alive) для LLM и заявок менеджеру; у PostgREST свой
+    пул с теми же настройками. llm — AsyncOpenAI-совместимый клиент, db — Supabase
+    AsyncClient или объект с тем же table(...).execute().
+    """
+    global http, client, supabase
+    http = http_client or pooled_client()
+    client = llm or AsyncOpenAI(
+        api_key=OPENROUTER_API_KEY,
+        base_url="https://api.polza.ai/v1",
+        http_client=http
+    )
+    supabase = db or PooledSupabase(SUPABASE_URL, SUPABASE_KEY)
+
+
+class ConfigCache:
+    """Снимок конфигурации (settings, воронка, файлы знаний, промпты) с TTL.
+
+    Пока TTL не истёк, данные отдаются из памяти. После истечения сначала делается
+    дешёвая проверка max(updated_at) и числа строк — полная перезагрузка только если
+    что-то реально поменялось. Правку строки на месте проверка видит, только если
+    updated_at обновляет триггер (migrations/003_*.sql); без него такие правки
+    подхватываются полной перезагрузкой раз в max_age секунд. invalidate()
+    сбрасывает снимок (команда /reload).
+    """
+
+    PROBE_TABLES = ("settings", "funnel_questions", "knowledge_files")
+
+    def __init__(self, ttl=CONFIG_TTL, max_age=CONFIG_MAX_AGE):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.settings = {}
+        self.funnel_questions = []
+        self.knowledge_files = []
+        self.version = 0
+        self.prompts = PromptBuilder(self.version, {}, [], [])
+        self._loaded_at = None
+        self._reloaded_at = None
+        self._fingerprint = None
+        self._probe_enabled = True
+        self._lock = asyncio.Lock()
+
+    def _is_fresh(self):
+        return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    async def get(self):
+        if self._is_fresh():
+            return self
+        async with self._lock:
+            if self._is_fresh():
+                return self
+            fingerprint = await self._probe()
+            too_old = self._reloaded_at is None or time.monotonic() - self._reloaded_at >= self.max_age
+            if self._loaded_at is not None and not too_old and fingerprint is not None and fingerprint == self._fingerprint:
+                self._loaded_at = time.monotonic()
+                return self
+            await self._reload(fingerprint)
+        return self
+
+    def invalidate(self):
+        self._loaded_at = None
+        self._fingerprint = None
+
+    async def _probe(self):
+        """Отпечаток таблиц конфигурации: (число строк, последний updated_at) по каждой"""
+        if not self._probe_enabled:
+            return None
+        try:
+            results = await asyncio.gather(*(
+                db_execute(f"probe_{t}", supabase.table(t).select("updated_at", count="exact").order("updated_at", desc=True).limit(1))
+                for t in self.PROBE_TABLES
+            ))
+            return tuple((r.count, r.data[0].get("updated_at") if r.data else None) for r in results)
+        except Exception as e:
+            # 42703 — в таблицах нет колонки updated_at: дальше работаем только по TTL
+            if getattr(e, "code", None) == "42703":
+                logger.warning(f"Config probe disabled: {e}")
+                self._probe_enabled = False
+            else:
+                logger.error(f"Config probe error: {e}")
+            return None
+
+    async def _reload(self, fingerprint):
+        try:
+            settings, funnel, files = await asyncio.gather(
+                db_execute("settings", supabase.table("settings").select("key,value")),
+                db_execute("funnel_questions", supabase.table("funnel_questions").select("id,question,agent_task,is_required").eq("is_required", True).order("order_index")),
+                db_execute("knowledge_files", supabase.table("knowledge_files").select("filename,content")),
+            )
+        except Exception as e:
+            # Оставляем предыдущий снимок, повторим при следующем обращении
+            logger.error(f"Error loading config: {e}")
+            return
+        snapshot = ({row["key"]: row["value"] for row in (settings.data or [])}, funnel.data or [], files.data or [])
+        if self._loaded_at is not None and snapshot == (self.settings, self.funnel_questions, self.knowledge_files):
+            # Плановое перечитывание без изменений: версия (и кэш ответов) остаются прежними
+            self._fingerprint = fingerprint
+            self._loaded_at = self._reloaded_at = time.monotonic()
+            return
+        self.settings, self.funnel_questions, self.knowledge_files = snapshot
+        try:
+            # Перестраиваются только изменившиеся файлы; CPU-работа — вне event loop
+            await asyncio.to_thread(knowledge.sync, self.knowledge_files)
+        except Exception as e:
+            logger.error(f"Error updating knowledge index: {e}")
+        self.version += 1
+        self.prompts = PromptBuilder(self.version, self.settings, self.knowledge_files, self.funnel_questions)
+        self._fingerprint = fingerprint
+        self._loaded_at = self._reloaded_at = time.monotonic()
+        logger.info(f"Config loaded: version={self.version}, funnel={len(self.funnel_questions)}, files={len(self.knowledge_files)}")
 
+    def flag(self, key, default="true"):
+        return self.settings.get(key, default) != "false"
 
-def get_system_prompt(funnel_questions):
-    try:
-        result = supabase.table("settings").select("key,value").execute()
-        data = {row["key"]: row["value"] for row in (result.data or [])}
-        niche = data.get("niche", "")
-        prompt = data.get("system_prompt", "Ты вежливый помощник-консультант.")
-        collect_name = data.get("collect_name", "true") != "false"
-        collect_phone = data.get("collect_phone", "true") != "false"
-
-        files_result = supabase.table("knowledge_files").select("filename,content").execute()
-        knowledge = ""
-        if files_result.data:
-            for f in files_result.data:
-                knowledge += f"\n\n--- {f['filename']} ---\n{f['content']}"
-
-        # Этапы воронки
-        funnel = ""
-        if funnel_questions:
-            stages = []
-            for q in funnel_questions:
-                task = q.get("agent_task") or q.get("question", "")
-                name = q.get("question", "")
-                stages.append(f"- Этап '{name}': {task}")
-            funnel = "\n\nЭТАПЫ ВОРОНКИ (задавай строго по одному, жди ответа):\n" + "\n".join(stages)
-
-        # Контакты — всегда в самом конце воронки
-        contact_steps = []
-        if collect_name:
-            contact_steps.append("- Узнай имя клиента (как к нему обращаться)")
-        if collect_phone:
-            contact_steps.append("- Узнай номер телефона для связи со специалистом")
-        if contact_steps:
-            funnel += "\n\nПОСЛЕ того как все этапы воронки пройдены — узнай контакты:\n" + "\n".join(contact_steps)
-
-        # Собираем промпт: ниша → файлы знаний → системный промпт → воронка → жёсткие правила формата последними
-        full_prompt = ""
-        if niche:
-            full_prompt += f"Ниша: {niche}\n\n"
-        if knowledge:
-            full_prompt += f"Файлы знаний:{knowledge}\n\n"
-        full_prompt += prompt
-        if funnel:
-            full_prompt += funnel
-
-        # Правила формата — последними, чтобы модель их не забывала
-        full_prompt += "\n\n---\nФОРМАТ ОТВЕТА (обязательно):\n- Максимум 2-3 предложения. Это жёсткое ограничение.\n- Только обычный текст — никаких **, *, #, ` и других символов разметки.\n- Каждый ответ заканчивается одним вопросом или конкретным шагом."
-
-        return full_prompt
-    except Exception as e:
-        logger.error(f"Error getting system prompt: {e}", exc_info=True)
-    return "Ты вежливый помощник-консультант."
+    def number(self, key, default):
+        try:
+            return int(self.settings.get(key) or default)
+        except ValueError:
+            return default
 
 
-def get_chat_history(chat_id, exclude_last=1):
-    try:
-        result = supabase.table("messages").select("role,content").eq("chat_id", chat_id).order("created_at").limit(20).execute()
-        data = result.data if result.data else []
-        if exclude_last and data:
-            data = data[:-exclude_last]
-        return data
-    except Exception as e:
-        logger.error(f"Error getting history: {e}")
-        return []
+config = ConfigCache()
 
 
-def save_message(chat_id, username, role, content):
-    try:
-        supabase.table("messages").insert({
-            "chat_id": chat_id,
-            "username": username,
-            "role": role,
-            "content": content
-        }).execute()
-    except Exception as e:
-        logger.error(f"Error saving message: {e}")
+def select_knowledge(cfg, user_message, history):
+    """Фрагменты знаний под текущий вопрос (с учётом последних реплик клиента).
 
+    None — поиск выключен (knowledge_top_k = 0), в промпт идут все файлы.
+    """
+    top_k = cfg.number("knowledge_top_k", KNOWLEDGE_TOP_K)
+    if top_k <= 0:
+        return None
+    recent = [m["content"] for m in history if m["role"] == "user"][-2:]
+    return knowledge.render(" ".join(recent + [user_message]), top_k)
 
-def get_contact_settings():
-    """Читает настройки сбора контактов"""
-    try:
-        result = supabase.table("settings").select("key,value").in_("key", ["collect_name", "collect_phone"]).execute()
-        data = {row["key"]: row["value"] for row in (result.data or [])}
-        collect_name = data.get("collect_name", "true") != "false"
-        collect_phone = data.get("collect_phone", "true") != "false"
-        return collect_name, collect_phone
-    except Exception as e:
-        logger.error(f"Error getting contact settings: {e}")
-        return True, True
 
+async def get_funnel_questions():
+    return (await config.get()).funnel_questions
 
-async def extract_and_save_data(chat_id, username, funnel_questions, all_messages, tg_username=""):
-    """Извлекает данные из диалога, сохраняет в collected_data и обновляет этап"""
-    try:
-        if not all_messages:
-            return
 
-        collect_name, collect_phone = get_contact_settings()
-        history_text = "\n".join([f"{m['role']}: {m['content']}" for m in all_messages[-20:]])
+async def get_prompt(stage, user_message, history):
+    """Неизменный промпт этапа и фрагменты знаний под текущий вопрос: (system, context)"""
+    cfg = await config.get()
+    return cfg.prompts.layout(stage, select_knowledge(cfg, user_message, history))
 
-        # --- Извлекаем имя и телефон отдельно ---
-        contact_update = {}
-        if collect_name or collect_phone:
-            contact_fields = []
-            if collect_name:
-                contact_fields.append("- Имя клиента (как представился)")
-            if collect_phone:
-                contact_fields.append("- Номер телефона (в любом формате)")
 
-            contact_prompt = f"""Из диалога ниже извлеки только эти данные если они были упомянуты:
-{chr(10).join(contact_fields)}
+def build_messages(cfg, system_prompt, window, context, user_message):
+    """Сначала всё, что повторяется от запроса к запросу (промпт, история), изменяемое — в последнем сообщении"""
+    system = {"role": "system", "content": system_prompt}
+    if cfg.flag("prompt_cache_control", "false"):
+        # Явная точка кэширования префикса для провайдеров, которые этого требуют (Anthropic)
+        system["content"] = [{"type": "text", "text": system_prompt, "cache_control": {"type": "ephemeral"}}]
+    return [system] + window + [{"role": "user", "content": with_context(context, user_message)}]
 
-Диалог:
-{history_text}
 
-Ответь ТОЛЬКО JSON. Используй ключи: "name" и/или "phone".
-Если не найдено — не включай ключ.
-Пример: {{"name": "Михаил", "phone": "89219503860"}}"""
+def estimate_reply_tokens(system_prompt, window, context, user_message, reply):
+    """Оценка токенов одного ответа (запрос + ответ) — столько экономит попадание в кэш"""
+    parts = [system_prompt, context, user_message, reply] + [m["content"] for m in window]
+    return sum(estimate_tokens(p) for p in parts)
 
-            resp = client.chat.completions.create(
-                model="anthropic/claude-3-haiku",
-                messages=[{"role": "user", "content": contact_prompt}],
-                max_tokens=100
-            )
-            raw = re.sub(r'```json|```', '', resp.choices[0].message.content.strip()).strip()
-            try:
-                contacts = json.loads(raw)
-                if collect_name and contacts.get("name"):
-                    contact_update["username"] = contacts["name"]
-                if collect_phone and contacts.get("phone"):
-                    contact_update["phone"] = contacts["phone"]
-            except Exception:
-                pass
-
-        # --- Извлекаем данные воронки ---
-        extracted = {}
-        if funnel_questions:
-            fields = "\n".join([f"- {q['question']}" for q in funnel_questions])
-            extraction_prompt = f"""Из диалога ниже извлеки следующие данные если они были упомянуты:
-{fields}
-
-Диалог:
-{history_text}
-
-Правила извлечения:
-- Текстовые числа переводи в цифры: "шесть семь" → "6-7", "около пяти" → "~5", "человек десять" → "10"
-- Сохраняй смысл даже если ответ неточный: "не знаю точно, человек семь наверное" → "~7"
-- Используй точные названия полей как ключи JSON
-- Если данные не найдены — не включай поле в ответ
-
-Ответь ТОЛЬКО в формате JSON.
-Пример: {{"Тип объекта": "дача", "Сколько человек": "6-7"}}"""
-
-            response = client.chat.completions.create(
-                model="anthropic/claude-3-haiku",
-                messages=[{"role": "user", "content": extraction_prompt}],
-                max_tokens=300
-            )
-            raw = re.sub(r'```json|```', '', response.choices[0].message.content.strip()).strip()
-            try:
-                extracted = json.loads(raw)
-            except Exception:
-                pass
-
-        # Получаем текущие данные лида
-        existing = supabase.table("leads").select("id,collected_data").eq("chat_id", chat_id).execute()
-        current_data = {}
-        if existing.data:
-            current_data = existing.data[0].get("collected_data") or {}
-        current_data.update(extracted)
-
-        # Получаем актуальные данные лида (телефон/имя могут уже быть)
-        current_phone = contact_update.get("phone") or (existing.data[0].get("phone") if existing.data else None)
-        current_name = contact_update.get("username") or (existing.data[0].get("username") if existing.data else None)
-
-        # Определяем этап по заполненным полям воронки
-        if funnel_questions:
-            filled = sum(1 for q in funnel_questions if current_data.get(q['question']))
-            total = len(funnel_questions)
-            if filled >= total:
-                # Воронка пройдена — проверяем телефон (обязателен) и имя (желательно)
-                if collect_phone and not current_phone:
-                    stage = "waiting_phone"  # ждём телефон
-                else:
-                    stage = "deal_won"
-            else:
-                stage = "new_lead"
-                for q in funnel_questions:
-                    if not current_data.get(q['question']):
-                        stage = f"question_{q['id']}"
-                        break
-        else:
-            stage = "new_lead"
 
-        # Формируем данные для сохранения
-        lead_data = {
-            "collected_data": current_data,
-            "stage": stage,
-            "username": contact_update.get("username", username),
-            "tg_username": tg_username,
-        }
-        if "phone" in contact_update:
-            lead_data["phone"] = contact_update["phone"]
+def response_cache_key(cfg, stage, user_message, history):
+    """response_cache в settings: consultation (по умолчанию) — только после deal_won, true — везде, false — выключен"""
+    mode = (cfg.settings.get("response_cache") or "consultation").strip().lower()
+    if not (mode == "true" or (mode == "consultation" and stage == "deal_won")):
+        return None
+    return ResponseCache.key(cfg.version, stage or "new", user_message, history)
 
-        if existing.data:
-            prev_stage = existing.data[0].get("stage") if existing.data else None
-            supabase.table("leads").update(lead_data).eq("chat_id", chat_id).execute()
-        else:
-            prev_stage = None
-            lead_data["chat_id"] = chat_id
-            supabase.table("leads").insert(lead_data).execute()
 
-        # Отправляем заявку менеджеру если только что стало deal_won
-        if stage == "deal_won" and prev_stage != "deal_won":
-            await send_deal_notification(chat_id, lead_data, current_data, funnel_questions)
+def personal_values(lead, first_name=""):
+    """Имя, телефон и ответы воронки клиента: ответ, где они прозвучали, в общий кэш не кладём"""
+    lead = lead or {}
+    values = [first_name, lead.get("username"), lead.get("tg_username"), lead.get("phone")]
+    values += (lead.get("collected_data") or {}).values()
+    return [v for v in values if v]
 
-        logger.info(f"Lead {chat_id}: stage={stage}, contacts={contact_update}, funnel={extracted}")
 
-    except Exception as e:
-        logger.error(f"Error extracting data: {e}")
+async def get_chat_history(chat_id, limit=HISTORY_LIMIT):
+    """Последние limit сообщений чата в хронологическом порядке.
 
+    Берём самые новые (desc + limit) и разворачиваем уже на клиенте; запрос
+    обслуживается индексом (chat_id, created_at desc) из migrations/001_*.sql.
+    Ошибки пробрасываются — пустую историю не кэшируем.
+    """
+    result = await db_execute("history", supabase.table("messages").select("role,content").eq("chat_id", chat_id).order("created_at", desc=True).limit(limit))
+    return list(reversed(result.data or []))
 
-async def send_deal_notification(chat_id, lead_data, collected_data, funnel_questions):
-    """Отправляет заявку менеджеру в Telegram когда лид достигает deal_won"""
-    try:
-        settings = supabase.table("settings").select("key,value").in_("key", ["manager_chat_id", "bot_token"]).execute()
-        s = {row["key"]: row["value"] for row in (settings.data or [])}
-        manager_chat_id = s.get("manager_chat_id", "").strip()
-        bot_token = s.get("bot_token", "").strip()
 
-        if not manager_chat_id or not bot_token:
-            logger.warning("manager_chat_id или bot_token не заданы — заявка не отправлена")
-            return
+async def get_lead(chat_id):
+    """Строка лида или None"""
+    result = await db_execute("lead", supabase.table("leads").select(",".join(LEAD_COLUMNS)).eq("chat_id", chat_id))
+    return result.data[0] if result.data else None
 
-        # Формируем текст заявки
-        name = lead_data.get("username") or "не указано"
-        phone = lead_data.get("phone") or "не указан"
-        tg_username = lead_data.get("tg_username") or ""
 
-        lines = ["🎯 Новая заявка!\n"]
-        lines.append(f"👤 Имя: {name}")
-        if tg_username:
-            lines.append(f"✈️ Telegram: @{tg_username} (https://t.me/{tg_username})")
-        else:
-            lines.append(f"✈️ Telegram: https://t.me/user?id={chat_id}")
-        lines.append(f"📞 Телефон: {phone}")
+async def load_chat_state(chat_id):
+    return await asyncio.gather(get_chat_history(chat_id), get_lead(chat_id))
 
-        if collected_data:
-            lines.append("")
-            for q in funnel_questions:
-                val = collected_data.get(q["question"])
-                if val:
-                    lines.append(f"• {q['question']}: {val}")
-
-        lines.append(f"\n💬 Чат в Telegram: {chat_id}")
-        text = "\n".join(lines)
-
-        import httpx
-        async with httpx.AsyncClient() as client:
-            resp = await client.post(
-                f"https://api.telegram.org/bot{bot_token}/sendMessage",
-                json={"chat_id": manager_chat_id, "text": text}
-            )
-            data = resp.json()
-            if not data.get("ok"):
-                logger.error(f"Ошибка отправки заявки менеджеру: {data}")
-            else:
-                logger.info(f"Заявка отправлена менеджеру в чат {manager_chat_id}")
-    except Exception as e:
-        logger.error(f"send_deal_notification error: {e}")
 
+chat_states = ChatStateCache(
+    load_chat_state, max_chats=CHAT_STATE_MAX_CHATS, idle_ttl=CHAT_STATE_IDLE_TTL, max_messages=HISTORY_LIMIT,
+    max_bytes_per_chat=CHAT_STATE_MAX_BYTES_PER_CHAT, max_bytes=CHAT_STATE_MAX_BYTES,
+)
 
-async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
-    first_name = update.message.from_user.first_name or ""
-    username = update.message.from_user.username or first_name
 
+async def get_chat_state(chat_id):
+    """Состояние чата из кэша; если база недоступна — пустое, без кэширования"""
     try:
-        result = supabase.table("settings").select("value").eq("key", "welcome_message").execute()
-        welcome = result.data[0]["value"] if result.data else "Добрый день! Чем могу помочь?"
+        return await chat_states.get(chat_id)
     except Exception as e:
-        logger.error(f"Error getting welcome message: {e}")
-        welcome = "Добрый день! Чем могу помочь?"
+        logger.error(f"Error loading chat state for {chat_id}: {e}")
+        return ChatState([], None, HISTORY_LIMIT, CHAT_STATE_MAX_BYTES_PER_CHAT)
 
-    if first_name:
-        welcome = welcome.replace("Добрый день!", f"Добрый день, {first_name}!")
 
-    save_message(chat_id, username, "assistant", welcome)
-    await update.message.reply_text(welcome)
+async def insert_messages(rows):
+    await db_execute("insert_messages", supabase.table("messages").insert(rows))
 
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    chat_id = update.message.chat_id
-    tg_username = update.message.from_user.username or ""
-    username = tg_username or update.message.from_user.first_name
-    user_message = update.message.text
+async def upsert_leads(rows):
+    await db_execute("upsert_leads", supabase.table("leads").upsert(rows, on_conflict="chat_id"))
 
-    logger.info(f"Message from {chat_id} ({username}): {user_message}")
-    await update.message.chat.send_action("typing")
 
-    save_message(chat_id, username, "user", user_message)
+def is_row_db_error(e):
+    """Ошибка конкретной строки (SQLSTATE 22 — данные, 23 — ограничения): её можно отбросить.
 
-    # Проверяем текущий этап лида
-    try:
-        lead_result = supabase.table("leads").select("stage").eq("chat_id", chat_id).execute()
-        current_stage = lead_result.data[0].get("stage") if lead_result.data else None
-    except Exception:
-        current_stage = None
+    Сеть, 5xx, схема (42xxx, PGRST1xx/2xx), права (401/403) касаются всей пачки —
+    строки остаются в буфере до исправления.
+    """
+    code = str(getattr(e, "code", None) or "")
+    return len(code) == 5 and code[:2] in ("22", "23")
 
-    funnel_questions = get_funnel_questions()
-    history = get_chat_history(chat_id, exclude_last=1)
-    all_messages = get_chat_history(chat_id, exclude_last=0)
 
-    if current_stage == "deal_won":
-        files_result = supabase.table("knowledge_files").select("filename,content").execute()
-        knowledge = ""
-        if files_result.data:
-            for f in files_result.data:
-                knowledge += f"\n\n--- {f['filename']} ---\n{f['content']}"
+# Сообщения копятся и уходят одним insert, обновления лида схлопываются по chat_id в один upsert.
+# Строку, которую база отвергает навсегда, буфер отбрасывает, а не повторяет всю пачку бесконечно
+message_writes = WriteBehindBuffer("messages", insert_messages, max_items=WRITE_BATCH_SIZE, max_delay=WRITE_FLUSH_INTERVAL, is_row_error=is_row_db_error)
+lead_writes = WriteBehindBuffer("leads", upsert_leads, max_items=WRITE_BATCH_SIZE, max_delay=WRITE_FLUSH_INTERVAL, key="chat_id", is_row_error=is_row_db_error)
 
-        system_prompt = f"""Заявка клиента уже передана специалисту. Теперь ты работаешь в режиме свободной консультации.
 
-ПРАВИЛА:
-1. Отвечай как живой эксперт — 3-5 предложений, без списков и таблиц.
-2. На вопросы про модели, цены, технические моменты — отвечай по делу используя файлы знаний.
-3. Если клиент спрашивает о статусе заявки — скажи что передана и специалист свяжется в ближайшее время.
-4. Не начинай воронку заново, не спрашивай телефон повторно.
-5. В конце ответа не обязательно задавать вопрос — можно просто дать полезную информацию.
-6. Только обычный текст — никаких таблиц, списков с цифрами, markdown разметки.
-7. АБСОЛЮТНЫЙ ЗАПРЕТ: никогда не называй бренды, марки и модели септиков — ни при каких условиях, даже если клиент прямо спрашивает. Вместо названий используй технические характеристики: "септик с принудительным отводом", "система для высокого УГВ". Если клиент настаивает — отвечай: "Конкретную модель подберёт инженер, он уже получил вашу заявку.{knowledge}"""
+async def flush_writes():
+    """Сбрасывает отложенные записи; ошибки каждого буфера — в лог"""
+    for buffer in (message_writes, lead_writes):
+        try:
+            await buffer.close()
+        except Exception as e:
+            logger.error(f"Error flushing {buffer.name}: {e}")
 
 
-    
-    else:
-        system_prompt = get_system_prompt(funnel_questions)
+async def save_message(chat_id, username, role, content):
+    chat_states.append_message(chat_id, role, content)
+    # created_at ставим сами: в пакетном insert у всех строк одно now() и порядок терялся бы
+    message_writes.add({
+        "chat_id": chat_id,
+        "username": username,
+        "role": role,
+        "content": content,
+        "created_at": datetime.now(timezone.utc).isoformat(),
+    })
 
-    messages = [{"role": "system", "content": system_prompt}] + history + [{"role": "user", "content": user_message}]
 
+async def get_contact_settings():
+    """Читает настройки сбора контактов"""
+    cfg = await config.get()
+    return cfg.flag("collect_name"), cfg.flag("collect_phone")
+
+
+async def extract_lead_fields(funnel_questions, collect_name, collect_phone, history_text):
+    """Контакты и поля воронки одним вызовом LLM: (contact_update, funnel_data)"""
+    if not (funnel_questions or collect_name or collect_phone):
+        return {}, {}
+    request = {
+        "model": "anthropic/claude-3-haiku",
+        "messages": [{"role": "user", "content": build_extraction_prompt(funnel_questions, collect_name, collect_phone, history_text)}],
+        "max_tokens": 400,
+    }
+    if (await config.get()).flag("extraction_json_schema", "false"):
+        # Structured output, если провайдер его поддерживает
+        request["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "lead_fields", "schema": extraction_schema(funnel_questions, collect_name, collect_phone)},
+        }
     try:
-        response = client.chat.completions.create(
-            model="anthropic/claude-3-haiku",
-            messages=messages,
-            max_tokens=600 if current_stage == "deal_won" else 300
+        async with llm_slot("extract"):
+            with timed(LLM_SECONDS, purpose="extract"):
+                response = await client.chat.completions.create(**request)
+    except Exception:
+        LLM_ERRORS.inc(purpose="extract")
+        raise
+    record_usage("extract", response)
+    return parse_extraction(response.choices[0].message.content, funnel_questions, collect_name, collect_phone)
+
+
+async def extract_and_save_data(chat_id, username, funnel_questions, all_messages, tg_username=""):
+    """Извлекает данные из диалога, сохраняет в collected_data и обновляет этап.
+
+    Выполняется в фоновой очереди jobs: ошибки не глушатся, очередь их логирует и повторяет.
+    """
+    if not all_messages:
+        return
+
+    collect_name, collect_phone = await get_contact_settings()
+
+    # Текущие данные лида — из состояния чата, без запроса к базе
+    state = await chat_states.get(chat_id)
+    lead = state.lead or {}
+    current_data = dict(lead.get("collected_data") or {})
+
+    # Имя, которое клиент уже назвал; имя из Telegram (подставляется по умолчанию) не в счёт
+    has_name = bool(lead.get("username")) and lead.get("username") not in (username, tg_username)
+
+    # Локальный предразбор: телефон/имя регулярками, LLM — только если могло прозвучать новое
+    pre = prefilter_message(all_messages[-1]["content"], lead.get("stage"), collect_name, collect_phone, has_name)
+    contact_update, extracted = {}, {}
+    if pre["mode"] != "skip":
+        window = all_messages[-2:] if pre["mode"] == "delta" else all_messages[-20:]
+        history_text = "\n".join([f"{m['role']}: {m['content']}" for m in window])
+        contact_update, extracted = await extract_lead_fields(funnel_questions, collect_name, collect_phone, history_text)
+    # Телефон из регулярки точнее, имя — наоборот, надёжнее у модели
+    if "phone" in pre["contacts"]:
+        contact_update["phone"] = pre["contacts"]["phone"]
+    # Угаданное по одному слову имя — только если LLM его подтвердил (тогда оно уже в contact_update)
+    if "username" in pre["contacts"] and not pre["name_guessed"]:
+        contact_update.setdefault("username", pre["contacts"]["username"])
+
+    if state.lead and not contact_update and not extracted:
+        logger.info(f"Lead {chat_id}: nothing new (prefilter={pre['mode']})")
+        return
+    current_data.update(extracted)
+
+    # Получаем актуальные данные лида (телефон/имя могут уже быть)
+    current_phone = contact_update.get("phone") or lead.get("phone")
+
+    # Определяем этап по заполненным полям воронки
+    if funnel_questions:
+        filled = sum(1 for q in funnel_questions if current_data.get(q['question']))
+        total = len(funnel_questions)
+        if filled >= total:
+            # Воронка пройдена — проверяем телефон (обязателен) и имя (желательно)
+            if collect_phone and not current_phone:
+                stage = "waiting_phone"  # ждём телефон
+            else:
+                stage = "deal_won"
+        else:
+            stage = "new_lead"
+            for q in funnel_questions:
+                if not current_data.get(q['question']):
+                    stage = f"question_{q['id']}"
+                    break
+    else:
+        stage = "new_lead"
+
+    # Формируем данные для сохранения
+    lead_data = {
+        "collected_data": current_data,
+        "stage": stage,
+        # Извлечение теперь может идти по последней паре реплик — уже известное имя не затираем
+        "username": contact_update.get("username") or lead.get("username") or username,
+        "tg_username": tg_username,
+    }
+    if "phone" in contact_update:
+        lead_data["phone"] = contact_update["phone"]
+
+    # Полная строка лида: в пакетном upsert отсутствующие колонки затёрлись бы null
+    prev_stage = lead.get("stage")
+    lead_data["chat_id"] = chat_id
+    chat_states.update_lead(chat_id, lead_data)
+    merged = {**lead, **lead_data}
+    lead_writes.add({column: merged.get(column) for column in LEAD_COLUMNS})
+
+    # Отправляем заявку менеджеру если только что стало deal_won.
+    # Отдельной задачей: её повтор не перезапускает извлечение
+    if stage == "deal_won" and prev_stage != "deal_won":
+        jobs.submit(chat_id, lambda: send_deal_notification(chat_id, lead_data, current_data, funnel_questions), "deal_notification")
+
+    logger.info(f"Lead {chat_id}: stage={stage}, prefilter={pre['mode']}, contacts={contact_update}, funnel={extracted}")
+
+
+async def send_deal_notification(chat_id, lead_data, collected_data, funnel_questions):
+    """Отправляет заявку менеджеру в Telegram когда лид достигает deal_won"""
+    s = (await config.get()).settings
+    manager_chat_id = (s.get("manager_chat_id") or "").strip()
+    bot_token = (s.get("bot_token") or "").strip()
+
+    if not manager_chat_id or not bot_token:
+        logger.warning("manager_chat_id или bot_token не заданы — заявка не отправлена")
+        return
+
+    # Формируем текст заявки
+    name = lead_data.get("username") or "не указано"
+    phone = lead_data.get("phone") or "не указан"
+    tg_username = lead_data.get("tg_username") or ""
+
+    lines = ["🎯 Новая заявка!\n"]
+    lines.append(f"👤 Имя: {name}")
+    if tg_username:
+        lines.append(f"✈️ Telegram: @{tg_username} (https://t.me/{tg_username})")
+    else:
+        lines.append(f"✈️ Telegram: https://t.me/user?id={chat_id}")
+    lines.append(f"📞 Телефон: {phone}")
+
+    if collected_data:
+        lines.append("")
+        for q in funnel_questions:
+            val = collected_data.get(q["question"])
+            if val:
+                lines.append(f"• {q['question']}: {val}")
+
+    lines.append(f"\n💬 Чат в Telegram: {chat_id}")
+    text = "\n".join(lines)
+
+    with timed(TG_SECONDS, method="notify"):
+        resp = await http.post(
+            f"https://api.telegram.org/bot{bot_token}/sendMessage",
+            json={"chat_id": manager_chat_id, "text": text}
         )
-        reply = response.choices[0].message.content.strip()
-        if not reply:
-            reply = "Уточните, пожалуйста, ваш вопрос."
-    except Exception as e:
-        logger.error(f"OpenRouter error: {e}", exc_info=True)
-        reply = "Произошла ошибка, попробуйте позже."
+    data = resp.json()
+    if not data.get("ok"):
+        # Исключение — чтобы очередь задач повторила отправку
+        raise RuntimeError(f"Ошибка отправки заявки менеджеру: {data}")
+    logger.info(f"Заявка отправлена менеджеру в чат {manager_chat_id}")
+
+
+def should_stream(cfg, stage):
+    """stream_replies в settings: false (по умолчанию), true — всегда, consultation — только после deal_won"""
+    mode = (cfg.settings.get("stream_replies") or "false").strip().lower()
+    return mode == "true" or (mode == "consultation" and stage == "deal_won")
+
+
+async def stream_reply(message, messages, max_tokens, edit_interval, received):
+    """Отвечает по мере генерации: первое предложение отдельным сообщением, дальше — правки.
+
+    Правки не чаще edit_interval секунд (лимиты Telegram на edit_message_text).
+    received — time.monotonic() прихода сообщения, от него считается время до первого текста.
+    Возвращает (текст ответа, дошёл ли поток до конца). Если поток оборвался до первого
+    сообщения — исключение.
+    """
+    # Место в лимите LLM и время LLM — до последнего чанка, вместе с отправкой промежуточных правок
+    async with llm_slot("reply"):
+        with timed(LLM_SECONDS, purpose="reply"):
+            stream = await client.chat.completions.create(
+                model="anthropic/claude-3-haiku",
+                messages=messages,
+                max_tokens=max_tokens,
+                stream=True,
+                stream_options={"include_usage": True}
+            )
+            text, shown, sent, last_edit = "", "", None, 0.0
+            complete = False
+            try:
+                async for chunk in stream:
+                    if getattr(chunk, "usage", None):
+                        record_usage("reply", chunk)
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if not delta:
+                        continue
+                    text += delta
+                    now = time.monotonic()
+                    if sent is None:
+                        # Первое сообщение — как только готово первое предложение
+                        cut = SENTENCE_END_RE.search(text)
+                        if cut or len(text) >= STREAM_FIRST_CHUNK_MAX:
+                            shown = text[:cut.end()].strip() if cut else text.strip()
+                            with timed(TG_SECONDS, method="reply"):
+                                sent = await message.reply_text(shown)
+                            last_edit = now
+                            FIRST_TEXT_SECONDS.observe(now - received, mode="stream")
+                            logger.info(f"Reply to {message.chat_id}: first text in {now - received:.2f}s (stream)")
+                    elif now - last_edit >= edit_interval and text.strip() != shown:
+                        shown = await edit_reply(sent, text.strip(), shown)
+                        last_edit = time.monotonic()
+                complete = True
+            except Exception as e:
+                if sent is None:
+                    raise
+                logger.error(f"Stream broken for {message.chat_id}, keeping partial reply: {e}")
+
+    reply = text.strip() or "Уточните, пожалуйста, ваш вопрос."
+    if sent is None:
+        with timed(TG_SECONDS, method="reply"):
+            await message.reply_text(reply)
+        FIRST_TEXT_SECONDS.observe(time.monotonic() - received, mode="stream")
+        logger.info(f"Reply to {message.chat_id}: first text in {time.monotonic() - received:.2f}s (stream)")
+    elif reply != shown:
+        await edit_reply(sent, reply, shown, final=True)
+    return reply, complete and bool(text.strip())
+
+
+async def edit_reply(sent, text, shown, final=False):
+    """Правит отправленное сообщение; при флуд-лимите промежуточную правку пропускаем"""
+    try:
+        with timed(TG_SECONDS, method="edit"):
+            await sent.edit_text(text)
+        return text
+    except RetryAfter as e:
+        if not final:
+            return shown
+        await asyncio.sleep(e.retry_after)
+        await sent.edit_text(text)
+        return text
+    except BadRequest as e:
+        # "Message is not modified" — текст уже такой
+        if "not modified" not in str(e).lower():
+            raise
+        return text
+
+
+async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    first_name = update.message.from_user.first_name or ""
+    username = update.message.from_user.username or first_name
+
+    welcome = (await config.get()).settings.get("welcome_message") or "Добрый день! Чем могу помочь?"
+
+    if first_name:
+        welcome = welcome.replace("Добрый день!", f"Добрый день, {first_name}!")
+
+    await save_message(chat_id, username, "assistant", welcome)
+    await update.message.reply_text(welcome)
+
+
+async def reload_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/reload — сбросить кэш настроек после правок в админке"""
+    chat_id = str(update.message.chat_id)
+    manager_chat_id = ((await config.get()).settings.get("manager_chat_id") or "").strip()
+    if chat_id not in ADMIN_CHAT_IDS and chat_id != manager_chat_id:
+        return
+    config.invalidate()
+    responses.clear()
+    cfg = await config.get()
+    await update.message.reply_text(f"Настройки перезагружены (версия {cfg.version}).")
 
-    save_message(chat_id, username, "assistant", reply)
 
-    # Извлекаем данные только если воронка ещё не завершена
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Сообщение клиента — в ход чата: серия сообщений подряд получает один ответ"""
+    message = update.message
+    logger.info(f"Message from {message.chat_id} ({message.from_user.username or message.from_user.first_name}): {message.text}")
+    # Время прихода — от него считаются bot_first_text_seconds и bot_handle_message_seconds
+    if not await turns.submit(message.chat_id, (update, time.monotonic())):
+        DROPPED_MESSAGES.inc()
+
+
+async def complete_reply(messages, max_tokens):
+    """Ответ без стриминга: (текст, можно ли его кэшировать)"""
+    async with llm_slot("reply"):
+        with timed(LLM_SECONDS, purpose="reply"):
+            response = await client.chat.completions.create(
+                model="anthropic/claude-3-haiku",
+                messages=messages,
+                max_tokens=max_tokens
+            )
+    record_usage("reply", response)
+    reply = response.choices[0].message.content.strip()
+    return reply or "Уточните, пожалуйста, ваш вопрос.", bool(reply)
+
+
+async def answer_turn(chat_id, items, dropped=()):
+    """Один ответ на все сообщения хода; отвечаем на последнее из них.
+
+    items — пары (update, время прихода); задержка считается от первого сообщения хода.
+    dropped — сообщения сверх COALESCE_MAX_MESSAGES: в модель не идут, но в переписке сохраняются.
+    """
+    updates = [update for update, _ in items]
+    received = items[0][1]
+    message = updates[-1].message
+    tg_username = message.from_user.username or ""
+    username = tg_username or message.from_user.first_name
+    user_message = "\n".join(u.message.text for u in updates)
+    stored_message = "\n".join([user_message] + [u.message.text for u, _ in dropped])
+    COALESCED_MESSAGES.inc(len(updates) - 1)
+
+    trace = start_trace()
+    # Ожидание склейки хода — отдельный этап в логе медленных сообщений
+    trace["coalesce"] = time.monotonic() - received
+    async with typing_keepalive(message.chat):
+        # История и этап — из состояния чата: в базу ходим только при промахе кэша
+        state = await get_chat_state(chat_id)
+        history = list(state.messages)
+        current_stage = state.stage
+        funnel_questions = await get_funnel_questions()
+
+        await save_message(chat_id, username, "user", stored_message)
+
+        system_prompt, knowledge_context = await get_prompt(current_stage, user_message, history)
+
+        # history_token_budget в settings: окно истории по оценке токенов вместо фиксированного числа сообщений
+        cfg = await config.get()
+        budget = cfg.number("history_token_budget", 0)
+        window = trim_history(history, budget) if budget > 0 else history
+        messages = build_messages(cfg, system_prompt, window, knowledge_context, user_message)
+
+        # Повторяющиеся вопросы — из кэша ответов, без вызова LLM; ключ включает последний обмен репликами
+        cache_key = response_cache_key(cfg, current_stage, user_message, window)
+        cached = None
+        if cache_key:
+            saved_before = responses.tokens_saved
+            cached = responses.get(cache_key)
+            RESPONSE_CACHE_LOOKUPS.inc(result="hit" if cached else "miss")
+            RESPONSE_CACHE_TOKENS.inc(responses.tokens_saved - saved_before)
+
+        max_tokens = 600 if current_stage == "deal_won" else 300
+        sent = False
+        cacheable = False
+        try:
+            if cached:
+                reply = cached
+                stats = responses.stats()
+                logger.info(f"Reply to {chat_id} from response cache (hit rate {stats['hit_rate']:.0%}, ~{stats['tokens_saved']} tokens saved)")
+            elif should_stream(cfg, current_stage):
+                edit_interval = cfg.number("stream_edit_interval_ms", STREAM_EDIT_INTERVAL_MS) / 1000
+                reply, cacheable = await retry_overloaded("reply", lambda: stream_reply(message, messages, max_tokens, edit_interval, received))
+                sent = True
+            else:
+                # Пока провайдер перегружен, клиент видит "печатает", а не ошибку
+                reply, cacheable = await retry_overloaded("reply", lambda: complete_reply(messages, max_tokens))
+        except Exception as e:
+            LLM_ERRORS.inc(purpose="reply")
+            logger.error(f"OpenRouter error: {e}", exc_info=True)
+            reply = "Произошла ошибка, попробуйте позже."
+
+        if cacheable and cache_key and mentions(reply, personal_values(state.lead, message.from_user.first_name)):
+            logger.info(f"Reply to {chat_id} mentions the client's data, not cached")
+        elif cacheable and cache_key:
+            responses.put(cache_key, reply, estimate_reply_tokens(system_prompt, window, knowledge_context, user_message, reply))
+
+        # Сначала ответ клиенту — остальное не должно его задерживать
+        if not sent:
+            with timed(TG_SECONDS, method="reply"):
+                await message.reply_text(reply)
+            FIRST_TEXT_SECONDS.observe(time.monotonic() - received, mode="full")
+            logger.info(f"Reply to {chat_id}: first text in {time.monotonic() - received:.2f}s")
+    await save_message(chat_id, username, "assistant", reply)
+
+    total = time.monotonic() - received
+    MESSAGE_SECONDS.observe(total)
+    stop_trace()
+    log_if_slow(f"message from {chat_id}", total, trace, SLOW_REQUEST_SECONDS)
+
+    # Извлекаем данные только если воронка ещё не завершена — в фоне, по порядку внутри чата
     if current_stage != "deal_won":
-        all_msgs = all_messages + [{"role": "user", "content": user_message}]
-        await extract_and_save_data(chat_id, username, funnel_questions, all_msgs, tg_username)
+        all_msgs = history + [{"role": "user", "content": user_message}]
+        jobs.submit(chat_id, lambda: extract_and_save_data(chat_id, username, funnel_questions, all_msgs, tg_username), "extract")
 
-    await update.message.reply_text(reply)
 
+turns = ChatTurns(answer_turn, window=COALESCE_WINDOW, max_wait=COALESCE_MAX_WAIT, max_messages=COALESCE_MAX_MESSAGES)
 
-def run_health_server():
-    """Запускает простой HTTP сервер для health check Timeweb"""
-    from http.server import HTTPServer, BaseHTTPRequestHandler
-    class Handler(BaseHTTPRequestHandler):
-        def do_GET(self):
-            self.send_response(200)
-            self.end_headers()
-            self.wfile.write(b"OK")
-        def log_message(self, format, *args):
-            pass
-    port = int(os.environ.get("PORT", 8000))
-    server = HTTPServer(("0.0.0.0", port), Handler)
-    server.serve_forever()
 
+_readiness = {"checked_at": float("-inf"), "db": None, "llm": None}
 
-def main():
-    logger.info("Starting bot...")
-    import threading
-    health_thread = threading.Thread(target=run_health_server, daemon=True)
-    health_thread.start()
-    logger.info("Health server started")
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+
+async def check_readiness():
+    """Доступность базы и LLM плюс глубина очередей; проверки сети кэшируются на HEALTH_CACHE_SECONDS"""
+    now = time.monotonic()
+    if now - _readiness["checked_at"] >= HEALTH_CACHE_SECONDS:
+        async def probe(check):
+            try:
+                await asyncio.wait_for(check, timeout=HEALTH_TIMEOUT)
+                return "ok"
+            except Exception as e:
+                return f"error: {type(e).__name__}: {e}"
+
+        db, llm = await asyncio.gather(
+            probe(db_execute("health", supabase.table("settings").select("key").limit(1))),
+            probe(client.models.list()),
+        )
+        _readiness.update(checked_at=now, db=db, llm=llm)
+    writes = {"messages": message_writes.stats(), "leads": lead_writes.stats()}
+    # Несколько сбросов подряд не прошли (схема, права, база лежит) — строки копятся в памяти
+    writes_ok = all(w["failures_in_row"] < WRITE_FAILURES_NOT_READY for w in writes.values())
+    return {
+        "ready": _readiness["db"] == "ok" and _readiness["llm"] == "ok" and writes_ok,
+        "db": _readiness["db"],
+        "llm": _readiness["llm"],
+        "jobs": jobs.depth,
+        "writes": writes,
+        "chats": chat_states.stats(),
+        "responses": responses.stats(),
+        "turns": turns.stats(),
+        "llm_slots_free": llm_slots._value,
+    }
+
+
+async def health_handler(request):
+    status = await check_readiness()
+    return web.json_response(status, status=200 if status["ready"] else 503)
+
+
+async def live_handler(request):
+    """Liveness для Timeweb: процесс жив и event loop отвечает"""
+    return web.Response(text="OK")
+
+
+async def metrics_handler(request):
+    """Метрики в текстовом формате Prometheus"""
+    return web.Response(body=REGISTRY.render().encode("utf-8"), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def webhook_handler(request):
+    """Апдейт от Telegram: проверяем секрет и отдаём в очередь PTB, обработка — в фоне"""
+    app = request.app["bot_app"]
+    if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    update = Update.de_json(await request.json(), app.bot)
+    await app.update_queue.put(update)
+    return web.Response()
+
+
+async def start_web_server(app):
+    """Один asyncio HTTP-сервер на PORT: /health, liveness и (в режиме webhook) приём апдейтов"""
+    web_app = web.Application()
+    web_app["bot_app"] = app
+    web_app.router.add_get("/health", health_handler)
+    web_app.router.add_get("/", live_handler)
+    web_app.router.add_get("/metrics", metrics_handler)
+    if WEBHOOK_URL:
+        web_app.router.add_post(WEBHOOK_PATH, webhook_handler)
+    runner = web.AppRunner(web_app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", PORT).start()
+    app.bot_data["web_runner"] = runner
+    logger.info(f"HTTP server started on port {PORT}")
+
+
+async def stop_web_server(app):
+    runner = app.bot_data.pop("web_runner", None)
+    if runner:
+        await runner.cleanup()
+
+
+async def close_http_clients():
+    """Закрывает пулы соединений (LLM и заявки — через client, он владеет http)"""
+    await client.close()
+    await supabase.postgrest.aclose()
+
+
+async def shutdown(app):
+    await stop_web_server(app)
+    await close_http_clients()
+
+
+async def drain_jobs(app):
+    """Перед остановкой дожидаемся фоновых задач и сбрасываем отложенные записи, чтобы не потерять лиды и заявки"""
+    logger.info(f"Draining job queue: {jobs.depth} jobs")
+    await jobs.drain()
+    await flush_writes()
+
+
+async def run_webhook(app):
+    """Режим webhook: апдейты приходят POST-ом на наш же HTTP-сервер, без опроса Telegram"""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:
+        await start_web_server(app)
+        await app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            drop_pending_updates=True,
+        )
+        await app.start()
+        logger.info("Bot is running (webhook)!")
+        await stop.wait()
+        # Сначала перестаём принимать апдейты, потом дорабатываем начатое
+        await stop_web_server(app)
+        await app.stop()
+        await drain_jobs(app)
+        await close_http_clients()
+
+
+def build_application():
+    # Запросы к Bot API (ответы, правки) — тоже по HTTP/2 с переиспользованием соединений
+    builder = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(CONCURRENT_UPDATES).http_version("2")
+    if WEBHOOK_URL:
+        builder = builder.updater(None)
+    else:
+        builder = builder.post_init(start_web_server).post_stop(drain_jobs).post_shutdown(shutdown)
+    app = builder.build()
     app.add_handler(CommandHandler("start", start_command))
+    app.add_handler(CommandHandler("reload", reload_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
-    logger.info("Bot is running!")
-    app.run_polling(drop_pending_updates=True)
+    return app
+
+
+def main():
+    logger.info("Starting bot...")
+    init_clients()
+    app = build_application()
+    if WEBHOOK_URL:
+        asyncio.run(run_webhook(app))
+    else:
+        logger.info("Bot is running!")
+        app.run_polling(drop_pending_updates=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+"""Состояние активных чатов в памяти: последние сообщения и данные лида"""
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+logger = logging.getLogger(__name__)
+
+
+def _message_size(message):
+    return len(message["content"].encode("utf-8"))
+
+
+def _lead_size(lead):
+    if not lead:
+        return 0
+    return sum(len(str(v).encode("utf-8")) for v in (lead.get("collected_data") or {}).values())
+
+
+class ChatState:
+    """Последние сообщения чата и строка лида (None — лида ещё нет).
+
+    size — примерный объём в байтах (тексты сообщений и собранные данные),
+    считается один раз и дальше поправляется при каждом изменении. Пока size
+    больше max_bytes, старые сообщения отбрасываются (последнее остаётся всегда).
+    """
+
+    __slots__ = ("messages", "lead", "touched", "size", "max_bytes")
+
+    def __init__(self, messages, lead, max_messages, max_bytes=None):
+        self.messages = deque(messages, maxlen=max_messages)
+        self.lead = lead
+        self.touched = time.monotonic()
+        self.max_bytes = max_bytes
+        self.size = sum(_message_size(m) for m in self.messages) + _lead_size(lead)
+        self._trim()
+
+    @property
+    def stage(self):
+        return self.lead.get("stage") if self.lead else None
+
+    def _trim(self):
+        while self.max_bytes and self.size > self.max_bytes and len(self.messages) > 1:
+            self.size -= _message_size(self.messages.popleft())
+
+    def append(self, message):
+        """Добавляет сообщение; возвращает изменение size"""
+        before = self.size
+        if len(self.messages) == self.messages.maxlen:
+            self.size -= _message_size(self.messages[0])
+        self.messages.append(message)
+        self.size += _message_size(message)
+        self._trim()
+        return self.size - before
+
+    def set_lead(self, lead):
+        """Заменяет строку лида; возвращает изменение size"""
+        before = self.size
+        self.size += _lead_size(lead) - _lead_size(self.lead)
+        self.lead = lead
+        self._trim()
+        return self.size - before
+
+
+class ChatStateCache:
+    """LRU-кэш состояний чатов с вытеснением по простою.
+
+    При промахе состояние один раз читается из базы через loader(chat_id) ->
+    (messages, lead), дальше обновляется на месте при записи сообщений и лида,
+    так что в установившемся режиме путь сообщения не читает из базы вообще.
+    Рассчитан на один процесс бота: другой процесс, пишущий в те же таблицы,
+    кэш не увидит до вытеснения.
+    Память ограничена дважды: у чата — max_bytes_per_chat, у всего кэша — max_bytes
+    (сверх него, как и сверх max_chats, вытесняются давно не тронутые чаты).
+    """
+
+    def __init__(self, loader, max_chats=1000, idle_ttl=1800, max_messages=20, max_bytes_per_chat=None, max_bytes=None):
+        self.loader = loader
+        self.max_chats = max_chats
+        self.idle_ttl = idle_ttl
+        self.max_messages = max_messages
+        self.max_bytes_per_chat = max_bytes_per_chat
+        self.max_bytes = max_bytes
+        self._states = OrderedDict()
+        self._loading = {}
+        self._bytes = 0  # сумма size по всем состояниям — stats() не обходит кэш
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, chat_id):
+        self._expire()
+        state = self._states.get(chat_id)
+        if state is not None:
+            self.hits += 1
+            state.touched = time.monotonic()
+            self._states.move_to_end(chat_id)
+            return state
+        # Параллельные промахи по одному чату ждут одну загрузку
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = self._loading[chat_id] = asyncio.ensure_future(self._load(chat_id))
+            loading.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        return await asyncio.shield(loading)
+
+    async def _load(self, chat_id):
+        self.misses += 1
+        messages, lead = await self.loader(chat_id)
+        state = ChatState(messages, lead, self.max_messages, self.max_bytes_per_chat)
+        self._drop(chat_id)
+        self._states[chat_id] = state
+        self._bytes += state.size
+        self._evict()
+        stats = self.stats()
+        logger.info(f"Chat state loaded for {chat_id}: chats={stats['chats']}, ~{stats['bytes'] // 1024} KB, hit rate {stats['hit_rate']:.0%}")
+        return state
+
+    def _drop(self, chat_id):
+        state = self._states.pop(chat_id, None)
+        if state is not None:
+            self._bytes -= state.size
+
+    def _evict(self):
+        # Давно не тронутые — в начале OrderedDict; единственный оставшийся чат не вытесняем
+        while len(self._states) > self.max_chats or (self.max_bytes and self._bytes > self.max_bytes and len(self._states) > 1):
+            self._drop(next(iter(self._states)))
+
+    def _expire(self):
+        # Самые давно тронутые — в начале OrderedDict
+        deadline = time.monotonic() - self.idle_ttl
+        while self._states:
+            chat_id, state = next(iter(self._states.items()))
+            if state.touched >= deadline:
+                break
+            self._drop(chat_id)
+
+    def append_message(self, chat_id, role, content):
+        state = self._states.get(chat_id)
+        if state is not None:
+            self._bytes += state.append({"role": role, "content": content})
+            self._evict()
+
+    def update_lead(self, chat_id, lead_data):
+        state = self._states.get(chat_id)
+        if state is not None:
+            self._bytes += state.set_lead({**(state.lead or {}), **lead_data})
+            self._evict()
+
+    def invalidate(self, chat_id=None):
+        if chat_id is None:
+            self._states.clear()
+            self._bytes = 0
+        else:
+            self._drop(chat_id)
+
+    def stats(self):
+        total = self._bytes
+        requests = self.hits + self.misses
+        return {
+            "chats": len(self._states),
+            "bytes": total,
+            "bytes_per_chat": total // len(self._states) if self._states else 0,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
@@ -0,0 +1,213 @@
+"""Извлечение контактов и ответов воронки: локальный предразбор реплики и один запрос к LLM"""
+import re
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+_PHONE_DIGITS_MIN = 10
+
+# +7/8/7 и код из трёх цифр с любыми разделителями, либо голый мобильный 9xxxxxxxxx
+PHONE_RE = re.compile(
+    r"(?<![\d+])(?:(?:\+7|8|7)[\s\-]*\(?\d{3}\)?|\(?9\d{2}\)?)[\s\-]*\d{3}[\s\-]*\d{2}[\s\-]*\d{2}(?!\d)"
+)
+# Только явные представления: "Это Дача", "Это Подмосковье" — ответы, а не имена
+NAME_RE = re.compile(r"(?i:меня зовут|зовут меня|мо[её] имя|я\s*[-—])\s+([А-ЯЁ][а-яё]{1,20})\b")
+_WORD_RE = re.compile(r"[a-zа-яё0-9]+")
+# Реплики, в которых не бывает новых данных лида
+FILLER_WORDS = {
+    "привет", "здравствуйте", "здрасте", "добрый", "доброе", "день", "вечер", "утро", "спасибо", "благодарю",
+    "ок", "окей", "ok", "понятно", "ясно", "хорошо", "ладно", "угу", "ага", "отлично", "супер", "класс",
+    "пожалуйста", "жду", "понял", "поняла", "принято", "еще", "ещё", "раз", "вам", "большое",
+}
+QUESTION_WORDS = {"а", "как", "какой", "какая", "какие", "каким", "сколько", "что", "где", "когда", "почему", "зачем", "можно", "есть", "чем", "кто"}
+DELTA_MAX_CHARS = 120
+
+
+def extraction_schema(funnel_questions, collect_name, collect_phone):
+    """JSON Schema ответа: контакты на верхнем уровне, поля воронки — в funnel"""
+    properties = {}
+    if collect_name:
+        properties["name"] = {"type": "string"}
+    if collect_phone:
+        properties["phone"] = {"type": "string"}
+    properties["funnel"] = {
+        "type": "object",
+        "properties": {q["question"]: {"type": "string"} for q in funnel_questions},
+        "additionalProperties": False,
+    }
+    return {"type": "object", "properties": properties, "additionalProperties": False}
+
+
+def build_extraction_prompt(funnel_questions, collect_name, collect_phone, history_text):
+    contact_fields = []
+    if collect_name:
+        contact_fields.append('- "name": имя клиента (как представился)')
+    if collect_phone:
+        contact_fields.append('- "phone": номер телефона (в любом формате)')
+    funnel_fields = "\n".join(f"- {q['question']}" for q in funnel_questions) or "- (нет)"
+
+    return f"""Из диалога ниже извлеки данные клиента, если они были упомянуты.
+
+Контакты (ключи верхнего уровня):
+{chr(10).join(contact_fields) or "- (не собираем)"}
+
+Данные воронки (объект "funnel", ключи — точные названия полей):
+{funnel_fields}
+
+Диалог:
+{history_text}
+
+Правила извлечения:
+- Текстовые числа переводи в цифры: "шесть семь" → "6-7", "около пяти" → "~5", "человек десять" → "10"
+- Сохраняй смысл даже если ответ неточный: "не знаю точно, человек семь наверное" → "~7"
+- Если данные не найдены — не включай ключ в ответ
+
+Ответь ТОЛЬКО JSON.
+Пример: {{"name": "Михаил", "phone": "89219503860", "funnel": {{"Тип объекта": "дача", "Сколько человек": "6-7"}}}}"""
+
+
+def _first_json_object(raw):
+    """Первый разбираемый JSON-объект в тексте (ответ может быть в ```json или с пояснениями)"""
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"\{", raw):
+        try:
+            obj, _ = decoder.raw_decode(raw, match.start())
+        except ValueError:
+            continue
+        if isinstance(obj, dict):
+            return obj
+    return None
+
+
+def _scalar(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if isinstance(value, str) and value.strip():
+        return value.strip()
+    return None
+
+
+def _valid_phone(value):
+    value = _scalar(value)
+    if value and len(re.sub(r"\D", "", value)) >= _PHONE_DIGITS_MIN:
+        return value
+    return None
+
+
+def _regex_field(raw, key):
+    """Запасной путь для битого JSON: достаём "key": "value" по одному полю"""
+    match = re.search(r'"%s"\s*:\s*"([^"]*)"' % re.escape(key), raw)
+    return match.group(1) if match else None
+
+
+def parse_extraction(raw, funnel_questions, collect_name, collect_phone):
+    """Разбирает ответ модели в (contact_update, funnel_data).
+
+    Каждое поле проверяется отдельно: невалидное поле отбрасывается, остальные
+    сохраняются. Если JSON не разобрался целиком, поля ищутся регуляркой.
+    """
+    raw = raw or ""
+    data = _first_json_object(raw)
+    if data is None:
+        logger.warning(f"Extraction: invalid JSON, falling back to per-field parsing: {raw[:200]!r}")
+        data = {"funnel": {}}
+        for key in ("name", "phone"):
+            data[key] = _regex_field(raw, key)
+        for q in funnel_questions:
+            data["funnel"][q["question"]] = _regex_field(raw, q["question"])
+
+    contact_update = {}
+    name = _scalar(data.get("name")) if collect_name else None
+    if name:
+        contact_update["username"] = name
+    phone = _valid_phone(data.get("phone")) if collect_phone else None
+    if phone:
+        contact_update["phone"] = phone
+
+    # Модель иногда кладёт поля воронки на верхний уровень — принимаем и так
+    funnel_raw = data.get("funnel") if isinstance(data.get("funnel"), dict) else {}
+    known = {q["question"].lower(): q["question"] for q in funnel_questions}
+    funnel_data = {}
+    for source in (data, funnel_raw):
+        for key, value in source.items():
+            field = known.get(str(key).strip().lower())
+            value = _scalar(value)
+            if field and value:
+                funnel_data[field] = value
+    return contact_update, funnel_data
+
+
+def find_phone(text):
+    match = PHONE_RE.search(text or "")
+    return match.group(0).strip() if match else None
+
+
+def find_name(text, awaiting_contacts=False, has_name=False):
+    """Имя: (имя, угадано ли оно) или (None, False).
+
+    Явное представление («меня зовут …») — всегда; одиночное слово с заглавной —
+    только на этапе контактов и только пока имени у лида нет: «Подумаю» или
+    «Ленобласть» в ответ на просьбу о телефоне — не имя.
+    """
+    match = NAME_RE.search(text or "")
+    if match:
+        return match.group(1), False
+    words = (text or "").strip().rstrip(".!").split()
+    if awaiting_contacts and not has_name and len(words) == 1 and re.fullmatch(r"[А-ЯЁ][а-яё]{1,20}", words[0]) and words[0].lower() not in FILLER_WORDS:
+        return words[0], True
+    return None, False
+
+
+def prefilter_message(text, stage, collect_name, collect_phone, has_name=False):
+    """Локальный разбор реплики клиента до вызова LLM.
+
+    Возвращает {"mode": ..., "contacts": {...}, "name_guessed": bool}:
+    - skip  — новых данных нет (или всё нашлось регулярками), LLM не нужен;
+      чистый вопрос пропускается только вне воронки и этапа контактов;
+    - delta — короткий ответ на текущий вопрос, хватит последней пары реплик;
+    - full  — полное извлечение по истории.
+    has_name — у лида уже есть имя: регулярками его не ищем, смену имени решает LLM.
+    Угаданное по одному слову имя LLM всегда перепроверяет (mode не skip).
+    """
+    text = (text or "").strip()
+    awaiting_contacts = stage == "waiting_phone"
+    contacts = {}
+    phone = find_phone(text) if collect_phone else None
+    if phone:
+        contacts["phone"] = phone
+    name, guessed = find_name(text, awaiting_contacts, has_name) if collect_name else (None, False)
+    if has_name:
+        # Уже сохранённое имя регуляркой не заменяем — «меня зовут …» разберёт LLM
+        name = None
+    if name:
+        contacts["username"] = name
+
+    def result(mode):
+        return {"mode": mode, "contacts": contacts, "name_guessed": guessed}
+
+    # Что осталось после вырезания телефона и имени
+    rest = PHONE_RE.sub(" ", text)
+    if name:
+        rest = NAME_RE.sub(" ", rest).replace(name, " ")
+    words = [w for w in _WORD_RE.findall(rest.lower()) if w not in FILLER_WORDS]
+
+    if not words:
+        # Реплика целиком ушла в имя: на вопросе воронки это мог быть и ответ — пусть решит LLM
+        if guessed or (name and stage and stage.startswith("question_")):
+            return result("delta")
+        return result("skip")
+    if awaiting_contacts and "phone" in contacts and (name or has_name or not collect_name):
+        # Ждём только контакты, и все найдены локально («Это Сергей, 8911…» — имя ищет LLM)
+        return result("skip")
+    answering = bool(stage) and (stage.startswith("question_") or awaiting_contacts)
+    pure_question = (
+        text.endswith("?") and words[0] in QUESTION_WORDS
+        and not any(ch.isdigit() for ch in rest) and not re.search(r"[,.;!]", text[:-1])
+    )
+    if pure_question and not answering:
+        return result("skip")
+    # Пока бот ждёт ответа, и вопросительная реплика может им быть: «Где-то человек пять?»
+    if answering and len(text) <= DELTA_MAX_CHARS:
+        return result("delta")
+    return result("full")
@@ -0,0 +1,31 @@
+"""Общие пулы HTTP-соединений: HTTP/2, keep-alive, единые лимиты и таймауты"""
+import os
+import httpx
+from postgrest._async.client import AsyncPostgrestClient
+from supabase import AsyncClient
+
+# Соединения живут между запросами — без нового TLS-рукопожатия на каждый вызов
+LIMITS = httpx.Limits(
+    max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=int(os.environ.get("HTTP_MAX_KEEPALIVE", "20")),
+    keepalive_expiry=float(os.environ.get("HTTP_KEEPALIVE_EXPIRY", "90")),
+)
+# Длинный read — под ответы LLM; connect и pool короткие, чтобы недоступность была видна быстро
+TIMEOUT = httpx.Timeout(60.0, connect=5.0, pool=10.0)
+
+
+def pooled_client(**kwargs):
+    return httpx.AsyncClient(http2=True, limits=LIMITS, timeout=TIMEOUT, **kwargs)
+
+
+class PooledPostgrestClient(AsyncPostgrestClient):
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return pooled_client(base_url=base_url, headers=headers, verify=verify, proxy=proxy, follow_redirects=True)
+
+
+class PooledSupabase(AsyncClient):
+    """AsyncClient, у которого PostgREST ходит через пул с общими настройками"""
+
+    @staticmethod
+    def _init_postgrest_client(rest_url, headers, schema, timeout=None, verify=True, proxy=None):
+        return PooledPostgrestClient(rest_url, headers=headers, schema=schema, verify=verify, proxy=proxy)
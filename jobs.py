@@ -0,0 +1,70 @@
+"""Фоновая очередь задач: последовательно внутри чата, ограниченно параллельно между чатами"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChatJobQueue:
+    """Очередь фоновых задач с сериализацией по ключу (chat_id).
+
+    Задачи одного чата выполняются строго по порядку постановки — переходы этапов
+    не гоняются друг с другом. Одновременно выполняется не больше max_concurrency
+    задач; упавшая задача повторяется retries раз с экспоненциальной паузой.
+    """
+
+    def __init__(self, max_concurrency=8, retries=2, retry_delay=1.0):
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._tails = {}      # chat_id -> последняя поставленная задача чата
+        self._tasks = set()
+        self.failed = 0
+
+    @property
+    def depth(self):
+        """Сколько задач ждёт или выполняется"""
+        return len(self._tasks)
+
+    def submit(self, key, job, name="job"):
+        """Ставит job (функция без аргументов, возвращающая корутину) в очередь чата key"""
+        prev = self._tails.get(key)
+        task = asyncio.create_task(self._run(key, prev, job, name))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    def _done(self, key, task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+
+    async def _run(self, key, prev, job, name):
+        if prev is not None:
+            # Ждём предыдущую задачу чата; её ошибки нас не касаются
+            await asyncio.wait([prev])
+        async with self._semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    await job()
+                    return
+                except Exception as e:
+                    if attempt == self.retries:
+                        self.failed += 1
+                        logger.error(f"Job {name} for {key} failed after {attempt + 1} attempts: {e}", exc_info=True)
+                        return
+                    logger.warning(f"Job {name} for {key} failed (attempt {attempt + 1}), retrying: {e}")
+                    await asyncio.sleep(self.retry_delay * 2 ** attempt)
+
+    async def drain(self, timeout=30):
+        """Дожидается всех задач, включая поставленные во время ожидания"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self._tasks:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                logger.warning(f"Job queue drain timed out, {len(self._tasks)} jobs left")
+                return False
+            await asyncio.wait(list(self._tasks), timeout=remaining)
+        return True
@@ -0,0 +1,187 @@
+"""Локальный BM25-индекс по knowledge_files.
+
+Файлы режутся на фрагменты по абзацам, по фрагментам строится инвертированный
+индекс. Индекс хранится на диске (JSON) и обновляется инкрементально: при sync()
+перестраиваются только файлы, у которых изменился хэш содержимого.
+
+Собрать или обновить индекс заранее, без запуска бота:
+
+    python knowledge_index.py
+"""
+import os
+import re
+import json
+import math
+import hashlib
+import logging
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+INDEX_FORMAT = 1
+CHUNK_CHARS = 800
+# Длина «основы» слова: грубый стемминг для русского (септик/септика/септиком → септик)
+STEM_CHARS = 6
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_STOPWORDS = {
+    "и", "в", "во", "на", "с", "со", "по", "к", "ко", "у", "о", "об", "от", "до", "из", "за", "для",
+    "не", "ни", "но", "а", "или", "же", "ли", "бы", "то", "это", "как", "что", "чтобы", "так",
+    "вы", "мы", "я", "он", "она", "они", "ты", "мне", "вам", "нам", "вас", "нас", "его", "ее", "её",
+    "есть", "был", "была", "было", "будет", "можно", "нужно", "если", "при", "уже", "еще", "ещё",
+}
+
+
+def tokenize(text):
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    return [w[:STEM_CHARS] for w in words if w not in _STOPWORDS and (len(w) > 1 or w.isdigit())]
+
+
+def split_chunks(text, max_chars=CHUNK_CHARS):
+    """Режет текст на фрагменты до max_chars, не разрывая абзацы без необходимости"""
+    chunks, current = [], ""
+    for para in re.split(r"\n\s*\n", text or ""):
+        para = para.strip()
+        if not para:
+            continue
+        # Слишком длинный абзац режем по предложениям
+        pieces = [para] if len(para) <= max_chars else re.split(r"(?<=[.!?])\s+", para)
+        for piece in pieces:
+            while len(piece) > max_chars:
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(piece[:max_chars])
+                piece = piece[max_chars:]
+            if current and len(current) + len(piece) + 2 > max_chars:
+                chunks.append(current)
+                current = ""
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def content_hash(text):
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+
+
+class KnowledgeIndex:
+    """Инвертированный BM25-индекс по фрагментам файлов знаний"""
+
+    def __init__(self, path=None):
+        self.path = path
+        self.files = {}      # filename -> {"hash": ..., "chunks": [chunk_id, ...]}
+        self.chunks = {}     # chunk_id -> {"file": ..., "text": ..., "len": ...}
+        self.postings = {}   # term -> {chunk_id: tf}
+        self._total_len = 0
+
+    @classmethod
+    def load(cls, path):
+        index = cls(path)
+        if not path or not os.path.exists(path):
+            return index
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+            if data.get("format") != INDEX_FORMAT:
+                return index
+            index.files = data["files"]
+            index.chunks = data["chunks"]
+            index.postings = data["postings"]
+            index._total_len = sum(c["len"] for c in index.chunks.values())
+        except Exception as e:
+            logger.error(f"Error loading knowledge index {path}: {e}")
+        return index
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"format": INDEX_FORMAT, "files": self.files, "chunks": self.chunks, "postings": self.postings}, f, ensure_ascii=False)
+        os.replace(tmp, self.path)
+
+    def sync(self, knowledge_files):
+        """Приводит индекс к текущему списку файлов. Возвращает число перестроенных файлов"""
+        current = {f["filename"]: f.get("content") or "" for f in knowledge_files or []}
+        changed = 0
+        for filename in list(self.files):
+            if filename not in current:
+                self._remove_file(filename)
+                changed += 1
+        for filename, content in current.items():
+            digest = content_hash(content)
+            if self.files.get(filename, {}).get("hash") == digest:
+                continue
+            self._remove_file(filename)
+            self._add_file(filename, content, digest)
+            changed += 1
+        if changed:
+            self.save()
+            logger.info(f"Knowledge index updated: files={changed}, chunks={len(self.chunks)}")
+        return changed
+
+    def _add_file(self, filename, content, digest):
+        ids = []
+        for i, text in enumerate(split_chunks(content)):
+            chunk_id = f"{filename}#{i}"
+            terms = Counter(tokenize(text))
+            length = sum(terms.values())
+            self.chunks[chunk_id] = {"file": filename, "text": text, "len": length}
+            self._total_len += length
+            for term, tf in terms.items():
+                self.postings.setdefault(term, {})[chunk_id] = tf
+            ids.append(chunk_id)
+        self.files[filename] = {"hash": digest, "chunks": ids}
+
+    def _remove_file(self, filename):
+        entry = self.files.pop(filename, None)
+        if not entry:
+            return
+        for chunk_id in entry["chunks"]:
+            chunk = self.chunks.pop(chunk_id, None)
+            if not chunk:
+                continue
+            self._total_len -= chunk["len"]
+            for term in set(tokenize(chunk["text"])):
+                posting = self.postings.get(term)
+                if posting:
+                    posting.pop(chunk_id, None)
+                    if not posting:
+                        del self.postings[term]
+
+    def search(self, query, top_k=4):
+        """Лучшие top_k фрагментов по BM25: [(score, chunk), ...]"""
+        n = len(self.chunks)
+        if not n or top_k <= 0:
+            return []
+        avgdl = self._total_len / n or 1
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for chunk_id, tf in posting.items():
+                dl = self.chunks[chunk_id]["len"]
+                scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + BM25_K1 * (1 - BM25_B + BM25_B * dl / avgdl))
+        best = sorted(scores.items(), key=lambda kv: kv[1], reverse=True)[:top_k]
+        return [(score, self.chunks[chunk_id]) for chunk_id, score in best]
+
+    def render(self, query, top_k=4):
+        """Фрагменты в том же виде, что и блок знаний в промпте"""
+        return "".join(f"\n\n--- {c['file']} ---\n{c['text']}" for _, c in self.search(query, top_k))
+
+
+if __name__ == "__main__":
+    from supabase import create_client
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+    db = create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"])
+    rows = db.table("knowledge_files").select("filename,content").execute().data or []
+    index = KnowledgeIndex.load(os.environ.get("KNOWLEDGE_INDEX_PATH", ".cache/knowledge_index.json"))
+    print(f"files={len(rows)} rebuilt={index.sync(rows)} chunks={len(index.chunks)}")
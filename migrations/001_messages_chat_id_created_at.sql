@@ -0,0 +1,6 @@
+-- Окно истории: последние N сообщений чата (get_chat_history в bot.py)
+--   select role, content from messages where chat_id = $1 order by created_at desc limit $2
+-- С этим индексом запрос читает ровно N строк индекса вместо сканирования
+-- и сортировки всей переписки чата, так что его стоимость не растёт с длиной диалога.
+create index concurrently if not exists messages_chat_id_created_at_idx
+    on messages (chat_id, created_at desc);
@@ -0,0 +1,5 @@
+-- upsert лидов по chat_id (lead_writes в bot.py: upsert(..., on_conflict="chat_id"))
+-- требует уникального ограничения на chat_id. Перед созданием убедитесь,
+-- что дублей нет:  select chat_id, count(*) from leads group by 1 having count(*) > 1;
+create unique index concurrently if not exists leads_chat_id_key
+    on leads (chat_id);
@@ -0,0 +1,28 @@
+-- Дешёвая проверка свежести конфигурации (ConfigCache._probe в bot.py):
+--   select updated_at from <таблица> order by updated_at desc limit 1  (+ count)
+-- Supabase сам не обновляет updated_at при UPDATE — без триггера правка
+-- system_prompt, приветствия или вопроса воронки «на месте» не меняет отпечаток,
+-- и бот подхватит её только по CONFIG_MAX_AGE, /reload или после перезапуска.
+alter table settings add column if not exists updated_at timestamptz not null default now();
+alter table funnel_questions add column if not exists updated_at timestamptz not null default now();
+alter table knowledge_files add column if not exists updated_at timestamptz not null default now();
+
+create or replace function touch_updated_at() returns trigger
+    language plpgsql as $$
+begin
+    new.updated_at := now();
+    return new;
+end;
+$$;
+
+drop trigger if exists settings_touch_updated_at on settings;
+create trigger settings_touch_updated_at before update on settings
+    for each row execute function touch_updated_at();
+
+drop trigger if exists funnel_questions_touch_updated_at on funnel_questions;
+create trigger funnel_questions_touch_updated_at before update on funnel_questions
+    for each row execute function touch_updated_at();
+
+drop trigger if exists knowledge_files_touch_updated_at on knowledge_files;
+create trigger knowledge_files_touch_updated_at before update on knowledge_files
+    for each row execute function touch_updated_at();
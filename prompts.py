@@ -0,0 +1,136 @@
+"""Сборка системных промптов из снимка конфигурации"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYSTEM_PROMPT = "Ты вежливый помощник-консультант."
+
+FORMAT_RULES = "\n\n---\nФОРМАТ ОТВЕТА (обязательно):\n- Максимум 2-3 предложения. Это жёсткое ограничение.\n- Только обычный текст — никаких **, *, #, ` и других символов разметки.\n- Каждый ответ заканчивается одним вопросом или конкретным шагом."
+
+# Режим свободной консультации после того как заявка передана (этап deal_won)
+CONSULTATION_PROMPT = """Заявка клиента уже передана специалисту. Теперь ты работаешь в режиме свободной консультации.
+
+ПРАВИЛА:
+1. Отвечай как живой эксперт — 3-5 предложений, без списков и таблиц.
+2. На вопросы про модели, цены, технические моменты — отвечай по делу используя файлы знаний.
+3. Если клиент спрашивает о статусе заявки — скажи что передана и специалист свяжется в ближайшее время.
+4. Не начинай воронку заново, не спрашивай телефон повторно.
+5. В конце ответа не обязательно задавать вопрос — можно просто дать полезную информацию.
+6. Только обычный текст — никаких таблиц, списков с цифрами, markdown разметки.
+7. АБСОЛЮТНЫЙ ЗАПРЕТ: никогда не называй бренды, марки и модели септиков — ни при каких условиях, даже если клиент прямо спрашивает. Вместо названий используй технические характеристики: "септик с принудительным отводом", "система для высокого УГВ". Если клиент настаивает — отвечай: "Конкретную модель подберёт инженер, он уже получил вашу заявку."""
+
+# Фрагменты знаний под текущий вопрос — в начале последнего сообщения клиента, а не в системном промпте
+KNOWLEDGE_CONTEXT_HEADER = "Справка из файлов знаний (используй, если относится к вопросу; клиенту не показывай):"
+KNOWLEDGE_CONTEXT_FOOTER = "\n\n---\nСообщение клиента:\n"
+
+
+def with_context(context, user_message):
+    """Последнее сообщение для модели: справка (если есть) и текст клиента"""
+    return f"{context}{KNOWLEDGE_CONTEXT_FOOTER}{user_message}" if context else user_message
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов (для кириллицы ~3 символа на токен)"""
+    return len(text) // 3 + 1 if text else 0
+
+
+def trim_history(messages, max_tokens):
+    """Самые новые сообщения, суммарно укладывающиеся в max_tokens (порядок сохраняется)"""
+    kept, total = [], 0
+    for m in reversed(messages):
+        total += estimate_tokens(m["content"])
+        if total > max_tokens:
+            break
+        kept.append(m)
+    return kept[::-1]
+
+
+def build_knowledge(knowledge_files):
+    """Склеивает файлы знаний в один блок (один раз на версию конфигурации)"""
+    return "".join(f"\n\n--- {f['filename']} ---\n{f['content']}" for f in knowledge_files or [])
+
+
+class PromptBuilder:
+    """Промпты одной версии конфигурации.
+
+    Блок знаний склеивается один раз, статичные части промптов запоминаются —
+    на горячем пути остаётся подставить фрагменты знаний между ними.
+    """
+
+    def __init__(self, version, settings, knowledge_files, funnel_questions):
+        self.version = version
+        self.settings = settings
+        self.funnel_questions = funnel_questions
+        self.knowledge = build_knowledge(knowledge_files)
+        self._memo = {}
+
+    def for_stage(self, stage, knowledge=None):
+        """Промпт для текущего этапа лида: консультация после deal_won, иначе воронка.
+
+        knowledge — отобранные фрагменты знаний; None — все файлы целиком.
+        """
+        mode = "consultation" if stage == "deal_won" else "funnel"
+        parts = self._memo.get(mode)
+        if parts is None:
+            parts = self._memo[mode] = self.consultation_parts() if mode == "consultation" else self.funnel_parts()
+        head, tail = parts
+        if knowledge is None:
+            knowledge = self.knowledge
+        if mode == "funnel" and knowledge:
+            knowledge = f"Файлы знаний:{knowledge}\n\n"
+        return head + knowledge + tail
+
+    def layout(self, stage, knowledge=None):
+        """Промпт этапа без изменяемых частей и контекст для последнего сообщения: (system, context).
+
+        Системный промпт одинаков до байта для всех запросов этапа в пределах версии
+        конфигурации — провайдер может кэшировать этот префикс. Фрагменты знаний,
+        подобранные под вопрос, идут в context; None вместо knowledge — все файлы
+        целиком, они и так не меняются и остаются в системном промпте.
+        """
+        if knowledge is None:
+            return self.for_stage(stage), ""
+        system = self.for_stage(stage, "")
+        return system, f"{KNOWLEDGE_CONTEXT_HEADER}{knowledge}" if knowledge else ""
+
+    def consultation_parts(self):
+        return CONSULTATION_PROMPT, ""
+
+    def funnel_parts(self):
+        """Статичные части промпта воронки: до блока знаний и после него"""
+        try:
+            niche = self.settings.get("niche", "")
+            prompt = self.settings.get("system_prompt", DEFAULT_SYSTEM_PROMPT)
+            collect_name = self.settings.get("collect_name", "true") != "false"
+            collect_phone = self.settings.get("collect_phone", "true") != "false"
+
+            # Этапы воронки
+            funnel = ""
+            if self.funnel_questions:
+                stages = []
+                for q in self.funnel_questions:
+                    task = q.get("agent_task") or q.get("question", "")
+                    name = q.get("question", "")
+                    stages.append(f"- Этап '{name}': {task}")
+                funnel = "\n\nЭТАПЫ ВОРОНКИ (задавай строго по одному, жди ответа):\n" + "\n".join(stages)
+
+            # Контакты — всегда в самом конце воронки
+            contact_steps = []
+            if collect_name:
+                contact_steps.append("- Узнай имя клиента (как к нему обращаться)")
+            if collect_phone:
+                contact_steps.append("- Узнай номер телефона для связи со специалистом")
+            if contact_steps:
+                funnel += "\n\nПОСЛЕ того как все этапы воронки пройдены — узнай контакты:\n" + "\n".join(contact_steps)
+
+            # Собираем промпт: ниша → файлы знаний → системный промпт → воронка → жёсткие правила формата последними
+            head = f"Ниша: {niche}\n\n" if niche else ""
+            tail = prompt + funnel
+
+            # Правила формата — последними, чтобы модель их не забывала
+            tail += FORMAT_RULES
+
+            return head, tail
+        except Exception as e:
+            logger.error(f"Error getting system prompt: {e}", exc_info=True)
+        return "", DEFAULT_SYSTEM_PROMPT
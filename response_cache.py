@@ -0,0 +1,97 @@
+"""Кэш готовых ответов на повторяющиеся вопросы (цены, монтаж, грунтовые воды)"""
+import re
+import time
+import hashlib
+from collections import OrderedDict
+
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+_SPACE_RE = re.compile(r"\s+")
+_NON_DIGIT_RE = re.compile(r"\D+")
+# Сколько последних реплик истории входит в ключ: вопрос клиента и ответ бота
+DIGEST_MESSAGES = 2
+
+
+def normalize_question(text):
+    """Регистр, ё/е, пунктуация и лишние пробелы не влияют на ключ"""
+    text = (text or "").lower().replace("ё", "е")
+    return _SPACE_RE.sub(" ", _PUNCT_RE.sub(" ", text)).strip()
+
+
+def history_digest(history):
+    """Короткий отпечаток последнего обмена репликами — к нему обычно и относится уточняющий вопрос"""
+    digest = hashlib.sha1()
+    for m in list(history)[-DIGEST_MESSAGES:]:
+        content = normalize_question(m["content"]) if m["role"] == "user" else m["content"]
+        digest.update(f"{m['role']}\0{content}\0".encode("utf-8"))
+    return digest.hexdigest()[:16]
+
+
+def mentions(text, values):
+    """Встречается ли в тексте одно из значений: целыми словами без учёта регистра, телефон — по цифрам"""
+    words = f" {normalize_question(text)} "
+    digits = _NON_DIGIT_RE.sub("", text or "")
+    for value in values:
+        value = str(value)
+        value_digits = _NON_DIGIT_RE.sub("", value)
+        if len(value_digits) >= 7 and value_digits[-7:] in digits:
+            return True
+        value = normalize_question(value)
+        if len(value) >= 3 and f" {value} " in words:
+            return True
+    return False
+
+
+class ResponseCache:
+    """LRU-кэш ответов с TTL.
+
+    Ключ — (версия конфигурации, режим, нормализованный вопрос, отпечаток последнего
+    обмена репликами), так что после /reload или смены файлов знаний старые ответы
+    не используются. Ответы с личными данными клиента сюда не кладутся — это
+    проверяет вызывающий код (см. mentions).
+    Для каждой записи помнится оценка токенов запроса и ответа — из неё считается
+    экономия при попадании.
+    """
+
+    def __init__(self, max_items=500, ttl=3600):
+        self.max_items = max_items
+        self.ttl = ttl
+        self._items = OrderedDict()  # key -> (reply, tokens, stored_at)
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+    @staticmethod
+    def key(version, mode, question, history=()):
+        return version, mode, normalize_question(question), history_digest(history)
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is not None and time.monotonic() - item[2] >= self.ttl:
+            del self._items[key]
+            item = None
+        if item is None:
+            self.misses += 1
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        self.tokens_saved += item[1]
+        return item[0]
+
+    def put(self, key, reply, tokens=0):
+        self._items[key] = (reply, tokens, time.monotonic())
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self):
+        requests = self.hits + self.misses
+        return {
+            "items": len(self._items),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "tokens_saved": self.tokens_saved,
+        }
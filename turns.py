@@ -0,0 +1,101 @@
+"""Склейка сообщений чата в ходы: серия коротких сообщений — один ответ"""
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class _Chat:
+    __slots__ = ("pending", "dropped", "future", "first_at", "last_at", "runner")
+
+    def __init__(self):
+        self.pending = []
+        self.dropped = []
+        self.future = None
+        self.first_at = None
+        self.last_at = None
+        self.runner = None
+
+
+class ChatTurns:
+    """Собирает сообщения чата в ходы и выполняет не больше одного хода на чат одновременно.
+
+    Ход начинается через window секунд тишины после последнего сообщения, но не
+    позже max_wait секунд после первого — поток сообщений не откладывает ответ
+    бесконечно. Сообщения, пришедшие во время хода, копятся в следующий. Больше
+    max_messages сообщений в одном ходе не берётся — остальные в ответ не идут
+    (защита от спама), но передаются тому же ходу отдельно, чтобы их сохранить.
+    handler(chat_id, items, dropped) получает сообщения хода и отброшенные из него.
+    """
+
+    def __init__(self, handler, window=0.8, max_wait=3.0, max_messages=10):
+        self.handler = handler
+        self.window = window
+        self.max_wait = max_wait
+        self.max_messages = max_messages
+        self._chats = {}
+        self.turns = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    @property
+    def active(self):
+        return len(self._chats)
+
+    async def submit(self, chat_id, item):
+        """Добавляет сообщение в ближайший ход чата.
+
+        Первое сообщение хода ждёт, пока ход отработает; остальные возвращаются сразу.
+        False — сообщение не попадёт в ответ (только в dropped хода).
+        """
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            chat = self._chats[chat_id] = _Chat()
+        if len(chat.pending) >= self.max_messages:
+            self.dropped += 1
+            chat.dropped.append(item)
+            logger.warning(f"Chat {chat_id}: {len(chat.pending)} messages already waiting, dropping one from the reply")
+            return False
+        now = asyncio.get_running_loop().time()
+        chat.pending.append(item)
+        chat.last_at = now
+        if chat.future is not None:
+            return True
+        chat.first_at = now
+        future = chat.future = asyncio.get_running_loop().create_future()
+        if chat.runner is None:
+            chat.runner = asyncio.ensure_future(self._run(chat_id, chat))
+        await asyncio.shield(future)
+        return True
+
+    async def _run(self, chat_id, chat):
+        loop = asyncio.get_running_loop()
+        try:
+            while chat.pending:
+                while True:
+                    start_at = min(chat.last_at + self.window, chat.first_at + self.max_wait)
+                    if loop.time() >= start_at:
+                        break
+                    await asyncio.sleep(start_at - loop.time())
+                items, dropped, future = chat.pending, chat.dropped, chat.future
+                chat.pending, chat.dropped, chat.future = [], [], None
+                self.turns += 1
+                self.coalesced += len(items) - 1
+                if len(items) > 1:
+                    logger.info(f"Chat {chat_id}: {len(items)} messages coalesced into one turn")
+                try:
+                    await self.handler(chat_id, items, dropped)
+                except Exception as e:
+                    logger.error(f"Turn for chat {chat_id} failed: {e}", exc_info=True)
+                finally:
+                    future.set_result(None)
+        finally:
+            chat.runner = None
+            if chat.future is not None and not chat.future.done():
+                # Runner отменён посреди ожидания — не оставляем первое сообщение хода висеть
+                chat.future.cancel()
+            if self._chats.get(chat_id) is chat:
+                del self._chats[chat_id]
+
+    def stats(self):
+        return {"active_chats": self.active, "turns": self.turns, "coalesced": self.coalesced, "dropped": self.dropped}
@@ -0,0 +1,143 @@
+"""Отложенная пакетная запись в базу (write-behind)"""
+import asyncio
+import itertools
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """Копит строки и пишет их в базу одним запросом.
+
+    Сброс — когда набралось max_items строк, через max_delay секунд после первой
+    строки, либо явным flush()/close() при остановке. С key строки с одинаковым
+    ключом схлопываются в одну (поздние поля поверх ранних), без key — копятся
+    по порядку. Если запись упала, строки возвращаются в буфер, ошибка пишется в
+    лог и в last_error, сброс повторяется с нарастающей паузой — так переживаются
+    и сбои сети, и ошибки схемы или прав, пока их не исправят. Только ошибку
+    одной строки (is_row_error(ошибка) — битое значение, нарушение ограничения)
+    пачка сужает делением пополам до виновной строки — она отбрасывается с
+    записью в лог, остальные строки пишутся.
+    """
+
+    def __init__(self, name, flush, max_items=50, max_delay=1.0, key=None, max_pending=10000, is_row_error=None):
+        self.name = name
+        self.is_row_error = is_row_error or (lambda e: False)
+        self.key = key
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self.max_pending = max_pending
+        self._flush_fn = flush
+        self._items = OrderedDict()
+        self._seq = itertools.count()
+        self._lock = asyncio.Lock()
+        self._timer = None
+        self._failed_in_row = 0
+        self.written = 0
+        self.batches = 0
+        self.failures = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.last_error = None
+
+    @property
+    def pending(self):
+        return len(self._items)
+
+    def add(self, item):
+        k = item[self.key] if self.key else next(self._seq)
+        if k in self._items:
+            item = {**self._items.pop(k), **item}
+        self._items[k] = item
+        if len(self._items) >= self.max_items:
+            self._schedule(0)
+        elif self._timer is None:
+            self._schedule(self.max_delay)
+
+    def _schedule(self, delay):
+        if self._timer is not None:
+            if delay:
+                return
+            self._timer.cancel()
+        self._timer = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        self._timer = None
+        try:
+            await self.flush()
+        except Exception:
+            # Уже в логе; пробуем ещё раз позже, пауза растёт до 30 секунд
+            if self._items and self._timer is None:
+                self._schedule(min(self.max_delay * 2 ** self._failed_in_row, 30))
+
+    async def flush(self):
+        """Пишет всё накопленное; при ошибке строки остаются в буфере, исключение пробрасывается"""
+        async with self._lock:
+            if not self._items:
+                return
+            batch, self._items = self._items, OrderedDict()
+            size = len(batch)
+            try:
+                await self._write(batch, list(batch.items()))
+            except Exception as e:
+                # В batch остались только незаписанные строки
+                self.failures += 1
+                self._failed_in_row += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                self._restore(batch)
+                logger.error(f"Write-behind {self.name}: flush of {size} rows failed ({self.pending} pending): {e}")
+                raise
+            self._failed_in_row = 0
+            self.batches += 1
+
+    async def _write(self, batch, items):
+        """Пишет items; записанные и отброшенные строки убирает из batch, ошибку не одной строки пробрасывает"""
+        try:
+            await self._flush_fn([item for _, item in items])
+        except Exception as e:
+            if not self.is_row_error(e):
+                raise
+            if len(items) == 1:
+                k, item = items[0]
+                del batch[k]
+                self.rejected += 1
+                self.last_error = f"{type(e).__name__}: {e}"
+                logger.error(f"Write-behind {self.name}: row rejected, dropping it: {e}; row={item}")
+                return
+            mid = len(items) // 2
+            await self._write(batch, items[:mid])
+            await self._write(batch, items[mid:])
+            return
+        for k, _ in items:
+            del batch[k]
+        self.written += len(items)
+
+    def _restore(self, batch):
+        """Возвращает несохранённые строки в начало буфера, более новые — поверх"""
+        for k, item in self._items.items():
+            batch[k] = {**batch[k], **item} if k in batch else item
+        self._items = batch
+        while len(self._items) > self.max_pending:
+            _, item = self._items.popitem(last=False)
+            self.dropped += 1
+            logger.error(f"Write-behind {self.name}: buffer full, dropped row {item}")
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+
+    def stats(self):
+        return {
+            "pending": self.pending,
+            "written": self.written,
+            "batches": self.batches,
+            "failures": self.failures,
+            "failures_in_row": self._failed_in_row,
+            "dropped": self.dropped,
+            "rejected": self.rejected,
+            "last_error": self.last_error,
+        }